@@ -1,5 +1,34 @@
+"""
+The catalog app.
+
+Importing the package defines the app and its routes without connecting to
+the database, the engine is created on first use (see database.py). Entry
+points call create_app() to finish the setup before serving.
+"""
+
+import os
+
 from flask import Flask
+from jinja2 import FileSystemBytecodeCache
+
 app = Flask(__name__) 
 
 import Catalog.welcome
 import Catalog.catalogViews
+from Catalog import config
+
+def create_app():
+    """Return the app ready to serve
+
+    Templates are compiled into a bytecode cache shared by the processes of
+    the host, so a new worker loads them instead of compiling them again.
+    Entries are keyed by the template source, so edited templates are
+    compiled again.
+    """
+    if config.TEMPLATE_BYTECODE_CACHE and app.jinja_env.bytecode_cache is None:
+        if config.TEMPLATE_CACHE_DIR and not os.path.isdir(config.TEMPLATE_CACHE_DIR):
+            os.makedirs(config.TEMPLATE_CACHE_DIR)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(config.TEMPLATE_CACHE_DIR or None)
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+    return app
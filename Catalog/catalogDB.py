@@ -1,43 +1,133 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, Text, DateTime
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, Text, DateTime
+from sqlalchemy import and_, or_, func
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, joinedload, subqueryload
 import datetime
-import urllib2
+import base64
 import os
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-
 import logging
 
+import config
+from database import DBSession, session, commit, after_commit, use_primary
+
+from jsonUtil import format_datetime
+from searchIndex import SearchIndex
+from imageIngest import ImageIngestor
+from imageStore import ImageStore
+from fragmentCache import fragment_cache
+
 Base = declarative_base()
 RELATIVE_FOLDER_PATH = "static/images/"
+PLACEHOLDER_SRC = "/static/placeholder.svg" # shown until an image is ready
+PAGE_SIZE = 12 # default number of rows in one page
+CURSOR_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+# How Item.image and Item.category are loaded by Item.eager:
+# 'joined' (LEFT OUTER JOIN), 'subquery' (one batched query per relation)
+# or 'select' (lazy, one query per item)
+ITEM_LOADING_STRATEGY = 'joined'
+LOADERS = {'joined': joinedload, 'subquery': subqueryload}
+BULK_CHUNK_SIZE = 500 # ids in one IN (...) list, below the SQLite variable limit
+
+def encode_cursor(row):
+    """Encode the (datetime, id) position of a row into an opaque cursor
+
+    Args:
+        row: Category or Item object
+    Returns:
+        url safe string like "MjAxNS0wMy0yMVQxMDoxMjozNC4wMDAwMDB8MTI="
+    """
+    val = "%s|%d" % (row.datetime.strftime(CURSOR_DATETIME_FORMAT), row.id)
+    return base64.urlsafe_b64encode(val.encode('ascii')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Decode a cursor made by encode_cursor
+
+    Returns:
+        (datetime, id) tuple, or None if cursor is empty or malformed
+    """
+    if not cursor:
+        return None
+    try:
+        val = base64.urlsafe_b64decode(str(cursor)).decode('ascii')
+        dt, row_id = val.split('|')
+        return datetime.datetime.strptime(dt, CURSOR_DATETIME_FORMAT), int(row_id)
+    except (TypeError, ValueError):
+        return None
+
+class Page(object):
+    """One page of rows returned by keyset pagination
+
+    Attributes:
+        items: list of rows, newest first
+        next_cursor: cursor of older rows, None if this is the last page
+        prev_cursor: cursor of newer rows, None if this is the first page
+    """
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
 
-def download_file(url):
-    """Download file from url to "static/images"
+def paginate(query, model, after = None, before = None, limit = PAGE_SIZE):
+    """Keyset pagination ordered by (datetime, id) descending
+
+    Rows are located by comparing with the position stored in the cursor
+    instead of OFFSET, so fetching any page only reads 'limit' rows.
 
-    Download file. Filename is automatically given by the url last part.
     Args:
-        url: string
+        query: query of model rows, may already be filtered
+        model: mapped class which has datetime and id columns
+        after: cursor, return rows older than it
+        before: cursor, return rows newer than it. Ignored if after is given.
+        limit: max number of rows in the page
     Returns:
-        file path: string, relative path like "static/images/120938120.jpg"
+        Page object
     """
-    baseFile = os.path.basename(url) # base file name
-    file_path = os.path.join(RELATIVE_FOLDER_PATH, baseFile)
-    req = urllib2.urlopen(url)
-    f = open(file_path, 'wb') # 'wb': write binary
-
-    file_size_dl = 0 # downloaded file size
-    block_sz = 8192
-    while True:
-        buffer = req.read(block_sz)
-        if not buffer:
-            break
-
-        file_size_dl += len(buffer)
-        f.write(buffer)
-    f.close()
-    return '/' + file_path
+    after = decode_cursor(after)
+    before = None if after else decode_cursor(before)
+    if before:
+        dt, row_id = before
+        query = query.filter(or_(model.datetime > dt,
+                                 and_(model.datetime == dt, model.id > row_id)))
+        query = query.order_by(model.datetime.asc(), model.id.asc())
+    else:
+        if after:
+            dt, row_id = after
+            query = query.filter(or_(model.datetime < dt,
+                                     and_(model.datetime == dt, model.id < row_id)))
+        query = query.order_by(model.datetime.desc(), model.id.desc())
+
+    # fetch one extra row to know whether there is another page
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before:
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if before:
+            next_cursor = encode_cursor(rows[-1])
+            prev_cursor = has_more and encode_cursor(rows[0]) or None
+        else:
+            next_cursor = has_more and encode_cursor(rows[-1]) or None
+            prev_cursor = after and encode_cursor(rows[0]) or None
+    return Page(rows, next_cursor, prev_cursor)
+
+def chunked(values, size = BULK_CHUNK_SIZE):
+    """Split values into lists of at most size, used for IN (...) lists"""
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+def load_search_index():
+    """Rows used to build search_index, items are streamed in batches"""
+    categories = session.query(Category.id, Category.name).all()
+    items = session.query(Item.id, Item.title, Item.desc, Item.category_id) \
+                   .execution_options(stream_results = True).yield_per(10000)
+    return categories, items
+
+search_index = SearchIndex(load_search_index)
 
 class Category(Base):
     """Category table
@@ -48,9 +138,11 @@ class Category(Base):
     Methods which interact row are instance methods.
     """
     __tablename__ = 'category'
+    # pages are ordered by (datetime, id), see paginate
+    __table_args__ = (Index('ix_category_datetime', 'datetime', 'id'),)
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(250), nullable=False)
+    name = Column(String(250), nullable=False, unique=True, index=True)
     datetime = Column(DateTime, default=datetime.datetime.now)
 
     @classmethod
@@ -65,33 +157,99 @@ class Category(Base):
     def get_all(cls):
         return list(session.query(Category).all())
 
+    @classmethod
+    def get_version(cls, category_id = None):
+        """(latest datetime, count) of all categories, or (datetime, 1) of one
+
+        Used as validator of the responses showing categories.
+        """
+        query = session.query(func.max(Category.datetime), func.count(Category.id))
+        if category_id is not None:
+            query = query.filter(Category.id == category_id)
+        return tuple(query.one())
+
+    @classmethod
+    def get_page(cls, after = None, before = None, limit = PAGE_SIZE):
+        """get one page of categories, newest first"""
+        return paginate(session.query(Category), Category, after, before, limit)
+
     @classmethod
     def store(cls, name):
         newCategory = Category(name = name)
         session.add(newCategory)
-        session.commit()
+        commit()
+        after_commit(search_index.add_category, newCategory)
+        after_commit(fragment_cache.invalidate, 'categories')
         return newCategory
 
     def update(self, name):
         """update name"""
         self.name = name
         self.datetime = datetime.datetime.now()
-        session.commit()
+        commit()
+        after_commit(search_index.add_category, self)
+        after_commit(fragment_cache.invalidate, 'categories', 'category:%s' % self.id)
 
     @classmethod
     def delete_by_id(cls, category_id):
-        """Remove all items in this category"""
-        itemsToDelete = Item.get_all_by_category(category_id)
-        for itemToDelete in itemsToDelete:
-            session.delete(itemToDelete)
-        categoryToDelete = Category.get_by_id(category_id)
-        session.delete(categoryToDelete)
-        session.commit()
+        """Remove the category with all its items and their images
+
+        Items are deleted by one statement, they aren't loaded.
+        """
+        Item.delete_by_category(category_id)
+        session.query(Category).filter_by(id = category_id) \
+               .delete(synchronize_session = 'evaluate')
+        commit()
+        after_commit(search_index.remove_category, category_id)
+        after_commit(fragment_cache.invalidate, 'categories', 'items', 'category:%s' % category_id)
 
     def get_all_items(self):
         """get all items in this category"""
         return Item.get_all_by_category(self.id)
 
+    @classmethod
+    def get_serialized_page(cls, after = None, before = None, limit = PAGE_SIZE):
+        """get one page of categories as serialized dicts
+
+        Only the needed columns are selected and no ORM object is built.
+        """
+        query = session.query(Category.id, Category.name, Category.datetime)
+        page = paginate(query, Category, after, before, limit)
+        page.items = [cls.serialize_row(row) for row in page.items]
+        return page
+
+    @classmethod
+    def iter_export_rows(cls, batch_size = 1000):
+        """Iterate over all categories joined with their items and images
+
+        Rows are ordered by category, so the items of a category are
+        contiguous. Categories without items have one row whose item columns
+        are None. Rows are fetched batch_size at a time through a server-side
+        cursor, so memory stays bounded however large the catalog is.
+
+        Yields:
+            rows with category_id, category_name, category_datetime, item_id,
+            title, desc, img_url, item_datetime
+        """
+        query = session.query(Category.id.label('category_id'),
+                              Category.name.label('category_name'),
+                              Category.datetime.label('category_datetime'),
+                              Item.id.label('item_id'), Item.title, Item.desc,
+                              Image.img_url, Item.datetime.label('item_datetime')) \
+                       .outerjoin(Item, Item.category_id == Category.id) \
+                       .outerjoin(Image, Item.img_id == Image.id) \
+                       .order_by(Category.id, Item.id)
+        return query.execution_options(stream_results = True).yield_per(batch_size)
+
+    @staticmethod
+    def serialize_row(row):
+        """Serialize a (id, name, datetime) row"""
+        return {
+            'datetime'   : format_datetime(row.datetime),
+            'name'       : row.name,
+            'id'         : row.id,
+        }
+
     @property
     def serialize(self):
        """Return object data in easily serializeable format"""
@@ -109,26 +267,77 @@ class Item(Base):
         title: String 
         desc: Text
         category_id: Foreign Key
-        img_id: Int
+        img_id: Foreign Key
+        ext_id: String, id of the item in an imported feed, None otherwise
         datetime(automatically updated after edited)
 
+    Relationships 'category' and 'image' are lazy by default, use Item.eager
+    to load them with the items in one round trip.
+
     Methods which interact Category table are classmethods.
     Methods which interact row are instance methods.
     """
     __tablename__ = 'item'
+    # listings of all items or of one category are ordered by (datetime, id)
+    __table_args__ = (Index('ix_item_datetime', 'datetime', 'id'),
+                      Index('ix_item_category_datetime', 'category_id', 'datetime', 'id'))
 
     id = Column(Integer, primary_key=True)
-    title = Column(String(250), nullable=False)
+    title = Column(String(250), nullable=False, index=True)
     desc = Column(Text)
     category_id = Column(Integer, ForeignKey('category.id'))
     category = relationship(Category)
-    img_id = Column(Integer, nullable=True)
+    img_id = Column(Integer, ForeignKey('image.id'), nullable=True, index=True)
+    image = relationship('Image')
+    ext_id = Column(String(250), unique=True, index=True)
     datetime = Column(DateTime, default=datetime.datetime.now)
 
+    @classmethod
+    def eager(cls, query, strategy = None):
+        """Load image and category together with the items of query
+
+        Args:
+            query: query of Item
+            strategy: 'joined', 'subquery' or 'select', default is
+                ITEM_LOADING_STRATEGY
+        Returns:
+            query with loader options
+        """
+        loader = LOADERS.get(strategy or ITEM_LOADING_STRATEGY)
+        if not loader:
+            return query
+        return query.options(loader(Item.image), loader(Item.category))
+
     @classmethod
     def get_by_id(cls, item_id):
         return session.query(Item).filter_by(id = item_id).one()
 
+    @classmethod
+    def get_version(cls, category_id = None):
+        """(latest datetime, count) of all items, or of items in a category
+
+        Deleting an item changes the count, adding or updating one changes
+        the datetime, so it is used as validator of item listings.
+        """
+        query = session.query(func.max(Item.datetime), func.count(Item.id))
+        if category_id is not None:
+            query = query.filter(Item.category_id == category_id)
+        return tuple(query.one())
+
+    @classmethod
+    def get_related_version(cls, item_id):
+        """datetimes of an item, its image and its category"""
+        row = session.query(Item.datetime, Image.datetime, Category.datetime) \
+                     .outerjoin(Image, Item.img_id == Image.id) \
+                     .outerjoin(Category, Item.category_id == Category.id) \
+                     .filter(Item.id == item_id).first()
+        return tuple(row or ())
+
+    @classmethod
+    def get_with_related(cls, item_id, strategy = None):
+        """get item with its image and category loaded"""
+        return cls.eager(session.query(Item), strategy).filter_by(id = item_id).one()
+
     @classmethod
     def get_by_title(cls, title):
         return session.query(Item).filter_by(title = title).first()
@@ -137,15 +346,35 @@ class Item(Base):
     def get_all_by_category(cls, category_id):
         return list(session.query(Item).filter_by(category_id = category_id).all())
 
+    @classmethod
+    def get_page(cls, category_id = None, after = None, before = None, limit = PAGE_SIZE, strategy = None):
+        """get one page of items with their images and categories, newest first
+
+        Args:
+            category_id: only items of this category if given
+            after, before: cursors from a previous Page
+            limit: page size
+            strategy: loading strategy, see Item.eager
+        Returns:
+            Page object
+        """
+        query = cls.eager(session.query(Item), strategy)
+        if category_id is not None:
+            query = query.filter_by(category_id = category_id)
+        return paginate(query, Item, after, before, limit)
+
     @classmethod
     def store(cls, title, desc, category_id, img_id):
         newItem = Item(title = title, desc = desc, category_id = category_id, img_id = img_id)
         session.add(newItem)
-        session.commit()
+        commit()
+        after_commit(search_index.add_item, newItem)
+        after_commit(fragment_cache.invalidate, 'items', 'category:%s' % category_id)
         return newItem
 
     def update(self, title = None, desc = None, category_id = None, img_id = None):
         """Update row data"""
+        old_category_id = self.category_id
         if title:
             self.title = title
         if desc:
@@ -156,30 +385,173 @@ class Item(Base):
             self.img_id = self.img_id
         if title or desc or category_id or img_id:
             self.datetime = datetime.datetime.now()
-            session.commit()
+            commit()
+            after_commit(search_index.add_item, self)
+            after_commit(fragment_cache.invalidate, 'items', 'category:%s' % old_category_id,
+                         'category:%s' % self.category_id)
 
     @classmethod
     def delete_by_id(cls, item_id):
-        itemToDelete = Item.get_by_id(item_id)
-        session.delete(itemToDelete)
-        session.commit()
+        cls.delete_by_ids([item_id])
+
+    @classmethod
+    def delete_by_ids(cls, item_ids):
+        """Delete items and the images no other item uses
+
+        One DELETE is issued for every BULK_CHUNK_SIZE ids. Item objects
+        already loaded in the session are not updated.
+
+        Returns:
+            number of deleted items
+        """
+        count = 0
+        image_ids = set()
+        category_ids = set()
+        for ids in chunked(set(item_ids)):
+            rows = session.query(Item.img_id, Item.category_id).filter(Item.id.in_(ids)).all()
+            image_ids.update(r.img_id for r in rows)
+            category_ids.update(r.category_id for r in rows)
+            count += session.query(Item).filter(Item.id.in_(ids)) \
+                            .delete(synchronize_session = False)
+        Image.delete_orphans(image_ids)
+        commit()
+        after_commit(search_index.remove_items, item_ids)
+        after_commit(fragment_cache.invalidate, 'items',
+                     *['category:%s' % c for c in category_ids])
+        return count
+
+    @classmethod
+    def delete_by_category(cls, category_id):
+        """Delete all items of a category in one statement, and their images
+
+        Returns:
+            number of deleted items
+        """
+        in_category = Item.category_id == category_id
+        image_ids = [r.img_id for r in session.query(Item.img_id).filter(in_category).distinct()]
+        count = session.query(Item).filter(in_category).delete(synchronize_session = 'evaluate')
+        Image.delete_orphans(image_ids)
+        commit()
+        after_commit(search_index.remove_category_items, category_id)
+        after_commit(fragment_cache.invalidate, 'items', 'category:%s' % category_id)
+        return count
+
+    @classmethod
+    def update_by_ids(cls, item_ids, **values):
+        """Set columns of items, one UPDATE every BULK_CHUNK_SIZE ids
+
+        Args:
+            values: column values, datetime is set to now
+        Returns:
+            number of updated items
+        """
+        count = 0
+        for ids in chunked(set(item_ids)):
+            category_ids = [r.category_id for r in
+                            session.query(Item.category_id).filter(Item.id.in_(ids)).distinct()]
+            count += cls._bulk_update(Item.id.in_(ids), values, category_ids)
+        return count
+
+    @classmethod
+    def update_by_category(cls, category_id, **values):
+        """Set columns of all items of a category in one UPDATE
+
+        Args:
+            values: column values, datetime is set to now
+        Returns:
+            number of updated items
+        """
+        return cls._bulk_update(Item.category_id == category_id, values, [category_id])
+
+    @classmethod
+    def _bulk_update(cls, criterion, values, category_ids):
+        values = dict(values, datetime = datetime.datetime.now())
+        count = session.query(Item).filter(criterion).update(values, synchronize_session = False)
+        commit()
+        if set(values) & set(['title', 'desc', 'category_id']):
+            # the updated rows aren't loaded, so build the index again
+            after_commit(search_index.reset)
+        tags = set('category:%s' % c for c in category_ids)
+        if 'category_id' in values:
+            tags.add('category:%s' % values['category_id'])
+        after_commit(fragment_cache.invalidate, 'items', *tags)
+        return count
+
+    @classmethod
+    def search(cls, q, page = 1, per_page = PAGE_SIZE):
+        """Search items by title, description and category name
+
+        Returns:
+            (SearchResult, list of items in this page, list of categories
+            whose name matches q)
+        """
+        result = search_index.search(q, page, per_page)
+        items = []
+        if result.item_ids:
+            found = cls.eager(session.query(Item)).filter(Item.id.in_(result.item_ids)).all()
+            by_id = dict((i.id, i) for i in found)
+            items = [by_id[i] for i in result.item_ids if i in by_id]
+        categories = []
+        if result.category_ids:
+            categories = session.query(Category).filter(Category.id.in_(result.category_ids)) \
+                                .order_by(Category.name).all()
+        return result, items, categories
 
     @classmethod
     def get_latest_10_items(cls):
-        result = session.query(Item).order_by(cls.datetime.desc()).all()
+        result = session.query(Item).order_by(cls.datetime.desc(), cls.id.desc()).limit(10).all()
         return result
 
+    @classmethod
+    def serialized_query(cls):
+        """Query of the columns used by Item.serialize_row
+
+        Image url and category name are fetched in the same statement by
+        outer joins, so serializing N items costs one query.
+        """
+        return session.query(Item.id, Item.title, Item.desc, Item.datetime,
+                             Image.img_url, Category.name.label('category_name')) \
+                      .outerjoin(Image, Item.img_id == Image.id) \
+                      .outerjoin(Category, Item.category_id == Category.id)
+
+    @classmethod
+    def get_serialized_page(cls, category_id = None, after = None, before = None, limit = PAGE_SIZE):
+        """get one page of items as serialized dicts, newest first"""
+        query = cls.serialized_query()
+        if category_id is not None:
+            query = query.filter(Item.category_id == category_id)
+        page = paginate(query, Item, after, before, limit)
+        page.items = [cls.serialize_row(row) for row in page.items]
+        return page
+
+    @classmethod
+    def get_serialized(cls, item_id):
+        """get a serialized item, raise NoResultFound if it doesn't exist"""
+        return cls.serialize_row(cls.serialized_query().filter(Item.id == item_id).one())
+
+    @staticmethod
+    def serialize_row(row):
+        """Serialize a row of Item.serialized_query"""
+        return {
+            'datetime'   : format_datetime(row.datetime),
+            'image_url'  : row.img_url,
+            'category'   : row.category_name,
+            'description'    : row.desc,
+            'title'      : row.title,
+            'id'         : row.id,
+        }
+
     def get_img(self):
-        """get image object"""
-        return session.query(Image).filter_by(id = self.img_id).one()
+        """get image object, no query if it was loaded by Item.eager"""
+        return self.image
 
     @property
     def serialize(self):
        """Return object data in easily serializeable format"""
        return {
            'datetime'   : self.datetime,
-           'image_url'  : Image.get_by_id(self.img_id).img_url,
-           'category'   : Category.get_by_id(self.category_id).name,
+           'image_url'  : self.image and self.image.img_url,
+           'category'   : self.category and self.category.name,
            'description'    : self.desc,
            'title'         : self.title,
            'id'         : self.id,
@@ -194,6 +566,10 @@ class Image(Base):
         path: String
         url: String
         src: String (Used for html src)
+        hash: String, sha256 of the downloaded file
+        thumb_src, medium_src: String, html src of resized copies
+        status: 'pending' while downloading in background, 'ready' or 'failed'
+        ext_id: String, ext_id of the imported item it was created for
         datetime(automatically updated after edited)
 
     Methods which interact Category table are classmethods.
@@ -206,36 +582,193 @@ class Image(Base):
     img_path = Column(String)
     img_url = Column(String)
     img_src = Column(String)
-    datetime = Column(DateTime, default=datetime.datetime.now)
+    img_hash = Column(String(64), index=True)
+    thumb_src = Column(String)
+    medium_src = Column(String)
+    status = Column(String(16), nullable=False, default='ready', server_default='ready', index=True)
+    ext_id = Column(String(250), index=True)
+    datetime = Column(DateTime, default=datetime.datetime.now, index=True)
+
+    @property
+    def display_src(self):
+        """html src, a placeholder until the image is downloaded"""
+        if self.status in (None, 'ready') and self.img_src:
+            return image_store.url(self.img_src)
+        return PLACEHOLDER_SRC
+
+    @property
+    def display_thumb_src(self):
+        """html src of the thumbnail, used in item grids"""
+        if self.status in (None, 'ready') and self.thumb_src:
+            return image_store.url(self.thumb_src)
+        return self.display_src
+
+    @property
+    def display_medium_src(self):
+        """html src of the medium size copy, used in item page"""
+        if self.status in (None, 'ready') and self.medium_src:
+            return image_store.url(self.medium_src)
+        return self.display_src
 
     @classmethod
     def store(cls, img_title, img_path, img_url):
-        """Download image if possible and store its local path"""
-        if img_url:
-            img_path = download_file(img_url)
-        img_src = img_path
-             
-        newImg = Image(img_title = img_title, img_path = img_path, img_url = img_url, img_src = img_src)
+        """Store image, its url is downloaded in background if given"""
+        status = img_url and 'pending' or 'ready'
+        newImg = Image(img_title = img_title, img_path = img_path, img_url = img_url,
+                       img_src = img_path, status = status)
         session.add(newImg)
-        session.commit()
+        commit()
+        if img_url:
+            # the worker reads the row with its own session, so only after commit
+            after_commit(newImg.ingest)
         return newImg
 
+    def ingest(self, block = False):
+        """Submit the download of img_url, mark failed if the queue is full
+
+        Args:
+            block: wait for a free place in the queue instead
+        """
+        if not image_ingestor.submit(self.id, self.img_url, block):
+            self.status = 'failed'
+            commit()
+
+    @classmethod
+    def finish_download(cls, img_id, stored, error):
+        """Called by image_ingestor worker threads after a download
+
+        The worker thread uses its own session, closed when done.
+        """
+        worker_session = DBSession()
+        use_primary(worker_session) # the image may not be on the replicas yet
+        try:
+            img = worker_session.query(Image).filter_by(id = img_id).first()
+            if img:
+                if stored:
+                    img.img_path = img.img_src = stored.src
+                    img.img_hash = stored.digest
+                    img.thumb_src = stored.thumb_src
+                    img.medium_src = stored.medium_src
+                    img.status = 'ready'
+                else:
+                    img.status = 'failed'
+                img.datetime = datetime.datetime.now()
+                worker_session.commit()
+                fragment_cache.invalidate('images')
+        finally:
+            worker_session.close()
+
+    @classmethod
+    def delete_orphans(cls, image_ids):
+        """Delete the images among image_ids which no item uses
+
+        Their stored files are removed after commit, unless another image
+        has the same content hash.
+
+        Returns:
+            number of deleted images
+        """
+        count = 0
+        files = {} # img_hash -> img_src of the deleted images
+        unused = ~session.query(Item.id).filter(Item.img_id == Image.id).exists()
+        for ids in chunked(set(image_ids) - set([None])):
+            orphan = and_(Image.id.in_(ids), unused)
+            files.update(session.query(Image.img_hash, Image.img_src)
+                                .filter(orphan, Image.img_hash != None))
+            count += session.query(Image).filter(orphan).delete(synchronize_session = False)
+        for hashes in chunked(files):
+            for (img_hash,) in session.query(Image.img_hash) \
+                                      .filter(Image.img_hash.in_(hashes)).distinct():
+                del files[img_hash]
+        commit()
+        if files:
+            after_commit(cls.remove_files, list(files.values()))
+        return count
+
+    @staticmethod
+    def remove_files(srcs):
+        """Remove stored files and their resized copies"""
+        for src in srcs:
+            try:
+                image_store.remove(src)
+            except EnvironmentError as e:
+                logging.warning('could not remove image %s: %s', src, e)
+
+    @classmethod
+    def requeue_pending(cls, block = False):
+        """Submit pending downloads again, e.g. after a restart
+
+        Args:
+            block: wait for free places in the queue, needed when there are
+                more pending images than the queue holds
+        Returns:
+            number of submitted images
+        """
+        pending = session.query(Image).filter_by(status = 'pending').all()
+        for img in pending:
+            img.ingest(block)
+        return len(pending)
+
+    @classmethod
+    def get_version(cls):
+        """Latest datetime of all images, it changes when a download ends"""
+        return session.query(func.max(Image.datetime)).scalar()
+
     @classmethod
     def get_by_id(cls, img_id):
         return session.query(Image).filter_by(id = img_id).one()
 
     def update(self, img_title, img_path, img_url):
+        """Update image, a new url is downloaded in background"""
         if img_path and img_url:
             img_url = None
+        new_url = img_url and img_url != self.img_url
         self.img_title = img_title
         self.img_path = img_path
         self.img_url = img_url
+        if new_url:
+            self.status = 'pending'
         self.datetime = datetime.datetime.now()
-        session.commit()
+        commit()
+        after_commit(fragment_cache.invalidate, 'images')
+        if new_url:
+            after_commit(self.ingest)
         
-# Use psycopg2 to access postgresql
-engine = create_engine('postgresql+psycopg2:///catalog')
-Base.metadata.create_all(engine)
+class User(Base):
+    """User table
+        
+    Columns: Id, Name, Hashed Password, Email Address
+
+    Methods which interact Category table are classmethods.
+    Methods which interact row are instance methods.
+    """
+    __tablename__ = 'user'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(250), nullable=False, unique=True, index=True)
+    pw_hash = Column(String(250), nullable=False)
+    email = Column(String(250))
+
+    @classmethod
+    def get_by_name(cls, name):
+        return session.query(User).filter_by(name = name).first()
+
+    @classmethod
+    def get_by_id(cls, uid):
+        return session.query(User).filter_by(id = uid).first()
+
+    @classmethod
+    def store(cls, name, pw_hash, email):
+        """return newly stored user object
+
+        Args:
+            pw_hash: hashed password made by loginManager.make_password
+        """
+        newUser = User(name=name, pw_hash=pw_hash, email=email)
+        session.add(newUser)
+        commit()
+        return newUser
+
+image_store = ImageStore(RELATIVE_FOLDER_PATH, config.IMAGE_URL_PREFIX)
+image_ingestor = ImageIngestor(image_store, Image.finish_download)
 
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
@@ -0,0 +1,100 @@
+"""
+Streaming full-catalog exports.
+
+The exports are generators of text chunks. Rows come from
+Category.iter_export_rows, so neither the rows nor the document are ever
+held in memory as a whole, and the first chunk is sent as soon as the first
+batch of rows arrives.
+"""
+
+from xml.sax.saxutils import escape, quoteattr
+
+from catalogDB import Category
+from jsonUtil import dumps, format_datetime
+
+BATCH_SIZE = 1000 # rows fetched from the database at a time
+CHUNK_ROWS = 200 # rows rendered into one chunk of the response
+
+def text(val):
+    """XML escaped text of val, empty if it is None"""
+    if val is None:
+        return u''
+    return escape(u'%s' % val)
+
+def group_by_category(rows):
+    """Group export rows of the same category
+
+    Yields:
+        (first row of the category, rows which have an item, is_last)
+        Items of a category are yielded in pieces of at most CHUNK_ROWS rows,
+        so a huge category is never held in memory. is_last is True for the
+        last piece of a category.
+    """
+    current = None
+    items = []
+    for row in rows:
+        if current is None or row.category_id != current.category_id:
+            if current is not None:
+                yield current, items, True
+            current, items = row, []
+        if row.item_id is not None:
+            items.append(row)
+            if len(items) >= CHUNK_ROWS:
+                yield current, items, False
+                items = []
+    if current is not None:
+        yield current, items, True
+
+def iter_xml(batch_size = BATCH_SIZE):
+    """Yield the catalog as an XML document in chunks"""
+    yield u'<?xml version="1.0" encoding="UTF-8"?>\n\n<catalog>\n'
+    opened = None
+    for category, items, last in group_by_category(Category.iter_export_rows(batch_size)):
+        chunk = []
+        if opened != category.category_id:
+            opened = category.category_id
+            chunk.append(u'    <category id=%s>\n        <name>%s</name>\n        <datetime>%s</datetime>\n'
+                         % (quoteattr(str(category.category_id)), text(category.category_name),
+                            text(category.category_datetime)))
+        for item in items:
+            chunk.append(u'        <item id=%s>\n            <title>%s</title>\n'
+                         u'            <description>%s</description>\n'
+                         u'            <img_url>%s</img_url>\n'
+                         u'            <datetime>%s</datetime>\n        </item>\n'
+                         % (quoteattr(str(item.item_id)), text(item.title), text(item.desc),
+                            text(item.img_url), text(item.item_datetime)))
+        if last:
+            chunk.append(u'    </category>\n')
+        yield u''.join(chunk)
+    yield u'</catalog>\n'
+
+def iter_json(batch_size = BATCH_SIZE):
+    """Yield the catalog as a JSON document in chunks
+
+    The document is {"Categories": [{"id", "name", "datetime", "Items": [...]}]}
+    and items have the same fields as Item.serialize_row.
+    """
+    yield u'{"Categories":['
+    opened = None
+    for category, items, last in group_by_category(Category.iter_export_rows(batch_size)):
+        chunk = []
+        if opened != category.category_id:
+            chunk.append(u'%s{"id":%d,"name":%s,"datetime":%s,"Items":['
+                         % (opened is not None and u',' or u'', category.category_id,
+                            dumps(category.category_name), dumps(format_datetime(category.category_datetime))))
+            opened = category.category_id
+            first_item = True
+        for item in items:
+            chunk.append((not first_item and u',' or u'') + dumps({
+                'datetime'   : format_datetime(item.item_datetime),
+                'image_url'  : item.img_url,
+                'category'   : category.category_name,
+                'description'    : item.desc,
+                'title'      : item.title,
+                'id'         : item.item_id,
+            }))
+            first_item = False
+        if last:
+            chunk.append(u']}')
+        yield u''.join(chunk)
+    yield u']}\n'
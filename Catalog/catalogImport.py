@@ -0,0 +1,275 @@
+"""
+Bulk import of item feeds.
+
+    python Catalog/catalogImport.py [options] FILE...
+
+Files are CSV with a header row or JSON lines, told apart by their extension
+or by --format. A row has the fields:
+
+    id: id of the item in the feed, "<category>/<title>" if missing
+    category: category name, the category is created if it doesn't exist
+    title
+    description
+    image_url: optional, downloaded in background
+
+Rows are streamed and inserted in batches of IMPORT_BATCH_SIZE. Each batch is
+one transaction with one executemany per table. Categories are resolved by
+name through a map loaded once. An item whose id was already imported is
+skipped, or updated with --update, so running an import again is harmless.
+The number of rows done is written to "<FILE>.checkpoint" after each batch,
+and an interrupted import starts again after them.
+"""
+
+import argparse
+import csv
+import datetime
+import logging
+import os
+import time
+
+from sqlalchemy import bindparam, func
+
+import config
+from catalogDB import Category, Item, Image, chunked, image_ingestor, RELATIVE_FOLDER_PATH
+from database import session, unit_of_work, after_commit
+from jsonUtil import dumps, loads
+
+APP_FOLDER = os.path.dirname(os.path.abspath(__file__))
+REPORT_INTERVAL = 5 # seconds between progress lines
+
+def read_rows(path, format = None):
+    """Yield the rows of a CSV or JSON lines file as dicts"""
+    format = format or (path.lower().endswith('.csv') and 'csv' or 'jsonl')
+    with open(path, 'rb') as f:
+        if format == 'csv':
+            for row in csv.DictReader(f):
+                yield dict((k, v.decode('utf-8')) for k, v in row.items() if k and v)
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield loads(line)
+
+def clean_row(row):
+    """Row with the columns to import, None if category or title is missing"""
+    category = (row.get('category') or '').strip()
+    title = (row.get('title') or '').strip()
+    if not category or not title:
+        return None
+    ext_id = row.get('id') or '%s/%s' % (category, title)
+    return dict(ext_id = ('%s' % ext_id)[:250],
+                category = category[:250],
+                title = title[:250],
+                desc = row.get('description') or '',
+                img_url = (row.get('image_url') or '').strip() or None)
+
+class Checkpoint(object):
+    """Number of rows of a file already imported, kept in a side file"""
+    def __init__(self, path):
+        self.path = path + '.checkpoint'
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path) as f:
+            return loads(f.read())['rows']
+
+    def save(self, rows):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(dumps({'rows': rows}))
+        os.rename(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class Importer(object):
+    """Inserts batches of clean rows
+
+    Attributes:
+        update: update items imported before instead of skipping them
+        images: submit image downloads, else images are left pending
+        category_ids: category name -> id
+        inserted, updated, skipped, invalid: row counters
+    """
+    def __init__(self, update = False, images = True):
+        self.update = update
+        self.images = images
+        self.category_ids = dict((c.name, c.id) for c in
+                                 session.query(Category.id, Category.name))
+        self.inserted = self.updated = self.skipped = self.invalid = 0
+
+    def import_batch(self, rows):
+        """Import rows in one transaction"""
+        now = datetime.datetime.now()
+        with unit_of_work():
+            self.add_categories(set(r['category'] for r in rows), now)
+            existing = self.find_items([r['ext_id'] for r in rows])
+            new_rows = []
+            old_rows = []
+            seen = set()
+            for r in rows:
+                if r['ext_id'] in seen:
+                    self.skipped += 1
+                    continue
+                seen.add(r['ext_id'])
+                if r['ext_id'] not in existing:
+                    new_rows.append(r)
+                elif self.update:
+                    old_rows.append(r)
+                else:
+                    self.skipped += 1
+
+            if new_rows:
+                images = self.add_images([r for r in new_rows if r['img_url']], now)
+                session.execute(Item.__table__.insert(), [
+                    dict(ext_id = r['ext_id'], title = r['title'], desc = r['desc'],
+                         category_id = self.category_ids[r['category']],
+                         img_id = images.get(r['ext_id']), datetime = now)
+                    for r in new_rows])
+                self.inserted += len(new_rows)
+                if self.images and images:
+                    urls = dict((r['ext_id'], r['img_url']) for r in new_rows)
+                    after_commit(self.submit_images,
+                                 [(img_id, urls[ext_id]) for ext_id, img_id in images.items()])
+            if old_rows:
+                table = Item.__table__
+                session.execute(table.update().where(table.c.ext_id == bindparam('_ext_id')), [
+                    dict(_ext_id = r['ext_id'], title = r['title'], desc = r['desc'],
+                         category_id = self.category_ids[r['category']], datetime = now)
+                    for r in old_rows])
+                self.updated += len(old_rows)
+
+    def add_categories(self, names, now):
+        """Insert the categories which don't exist and map their ids"""
+        new_names = [n for n in names if n not in self.category_ids]
+        if not new_names:
+            return
+        session.execute(Category.__table__.insert(),
+                        [dict(name = n, datetime = now) for n in new_names])
+        for chunk in chunked(new_names):
+            self.category_ids.update(
+                (c.name, c.id) for c in
+                session.query(Category.id, Category.name).filter(Category.name.in_(chunk)))
+
+    def find_items(self, ext_ids):
+        """ext_id -> id of the items already imported"""
+        found = {}
+        for chunk in chunked(set(ext_ids)):
+            found.update(session.query(Item.ext_id, Item.id).filter(Item.ext_id.in_(chunk)))
+        return found
+
+    def add_images(self, rows, now):
+        """Insert pending images for rows
+
+        Returns:
+            ext_id -> image id
+        """
+        if not rows:
+            return {}
+        session.execute(Image.__table__.insert(), [
+            dict(img_title = r['title'], img_url = r['img_url'], status = 'pending',
+                 ext_id = r['ext_id'], datetime = now)
+            for r in rows])
+        images = {}
+        for chunk in chunked(r['ext_id'] for r in rows):
+            images.update(session.query(Image.ext_id, func.max(Image.id))
+                                 .filter(Image.ext_id.in_(chunk))
+                                 .group_by(Image.ext_id))
+        return images
+
+    def submit_images(self, images):
+        """Queue downloads, waiting while the download queue is full"""
+        for img_id, url in images:
+            image_ingestor.submit(img_id, url, block = True)
+
+def import_file(importer, path, format = None, batch_size = config.IMPORT_BATCH_SIZE,
+                restart = False):
+    """Import one file, resuming after its checkpoint
+
+    Returns:
+        number of rows read after the checkpoint
+    """
+    checkpoint = Checkpoint(path)
+    done = 0 if restart else checkpoint.load()
+    if done:
+        logging.info('%s: resuming after row %d', path, done)
+    start = last_report = time.time()
+    rows_read = 0
+    batch = []
+
+    def flush():
+        importer.import_batch(batch)
+        checkpoint.save(rows_read)
+        del batch[:]
+
+    for row in read_rows(path, format):
+        rows_read += 1
+        if rows_read <= done:
+            continue
+        row = clean_row(row)
+        if row is None:
+            importer.invalid += 1
+            continue
+        batch.append(row)
+        if len(batch) >= batch_size:
+            flush()
+            if time.time() - last_report > REPORT_INTERVAL:
+                last_report = time.time()
+                logging.info('%s: %d rows, %.0f rows/s', path, rows_read,
+                             (rows_read - done) / (last_report - start))
+    if batch:
+        flush()
+    checkpoint.remove()
+
+    elapsed = max(time.time() - start, 1e-6)
+    logging.info('%s: %d rows in %.1fs, %.0f rows/s', path, rows_read - done, elapsed,
+                 (rows_read - done) / elapsed)
+    return rows_read - done
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Import items from CSV or JSON lines files')
+    parser.add_argument('files', nargs = '+', metavar = 'FILE')
+    parser.add_argument('--format', choices = ('csv', 'jsonl'),
+                        help = 'format of the files, by default told by their extension')
+    parser.add_argument('--batch-size', type = int, default = config.IMPORT_BATCH_SIZE,
+                        help = 'rows inserted per transaction')
+    parser.add_argument('--workers', type = int, default = config.IMPORT_IMAGE_WORKERS,
+                        help = 'concurrent image downloads')
+    parser.add_argument('--update', action = 'store_true',
+                        help = 'update the items imported before instead of skipping them')
+    parser.add_argument('--no-images', action = 'store_true',
+                        help = 'leave images pending, download them later with --pending')
+    parser.add_argument('--pending', action = 'store_true',
+                        help = 'also download the images left pending before')
+    parser.add_argument('--restart', action = 'store_true', help = 'ignore checkpoints')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO, format = '%(message)s')
+
+    # images are stored relative to the app folder, like when it is served
+    paths = [os.path.abspath(p) for p in args.files]
+    os.chdir(APP_FOLDER)
+    if not os.path.isdir(RELATIVE_FOLDER_PATH):
+        os.makedirs(RELATIVE_FOLDER_PATH)
+    image_ingestor.workers = image_ingestor.pool.max_per_host = args.workers
+
+    if args.pending:
+        logging.info('%d pending images queued', Image.requeue_pending(block = True))
+    importer = Importer(update = args.update, images = not args.no_images)
+    start = time.time()
+    rows = 0
+    for path in paths:
+        rows += import_file(importer, path, args.format, args.batch_size, args.restart)
+    elapsed = max(time.time() - start, 1e-6)
+    logging.info('%d rows in %.1fs, %.0f rows/s: %d inserted, %d updated, %d skipped, %d invalid',
+                 rows, elapsed, rows / elapsed, importer.inserted, importer.updated,
+                 importer.skipped, importer.invalid)
+
+    if not args.no_images or args.pending:
+        logging.info('waiting for %d image downloads', image_ingestor.depth)
+        image_ingestor.wait()
+        logging.info('images done in %.1fs', time.time() - start)
+
+if __name__ == '__main__':
+    main()
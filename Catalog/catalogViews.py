@@ -1,12 +1,39 @@
-from flask import make_response, render_template, request, redirect, jsonify, url_for, send_from_directory
+from flask import make_response, render_template, request, redirect, jsonify, url_for
+from flask import Response, stream_with_context, Markup
 from Catalog import app
 import logging
 
-from catalogDB import Base, Category, Item, Image 
+from catalogDB import Base, Category, Item, Image, PAGE_SIZE, search_index
 from loginManager import LoginManager, User, SECRET
-app.secret_key = SECRET
+from jsonUtil import json_response
+from conditional import conditional
+from fragmentCache import fragment_cache
+import catalogExport
+import queryStats
+import metrics
+import imageServing
+import compression
+import database
+from database import remove_session, transactional
 
 login_manager = LoginManager('/catalog')
+app.secret_key = SECRET
+app.teardown_appcontext(remove_session)
+database.init_app(app)
+# before load_user, so the user lookup is counted
+queryStats.init_app(app)
+# after queryStats, so its teardown runs first and still sees the query count
+metrics.init_app(app)
+imageServing.init_app(app)
+compression.init_app(app)
+app.before_request(login_manager.load_user)
+
+
+HOME_PAGE_SIZE = 12 # number of latest items shown in home page
+JSON_PAGE_SIZE = 100 # default number of rows in one JSON page
+JSON_MAX_PAGE_SIZE = 1000
+SUGGEST_SIZE = 10 # default number of suggestions
+SUGGEST_MAX_SIZE = 50
 
 
 def render_page(*a, **kw):
@@ -24,32 +51,81 @@ def redirect_url():
            request.referrer or \
            url_for('renderHomePage')
 
+def to_rows(items, col_num):
+    """Split items into a 2d list with col_num items in each row"""
+    return [items[i:i+col_num] for i in range(0, len(items), col_num)]
+
+def page_args(default_limit = PAGE_SIZE, max_limit = None):
+    """Read 'after', 'before' cursors and 'limit' from query string"""
+    limit = request.args.get('limit', default_limit, type = int)
+    limit = max(1, min(limit, max_limit or default_limit))
+    return dict(after = request.args.get('after'),
+                before = request.args.get('before'),
+                limit = limit)
+
+def page_json(page):
+    """Cursors of a Page in JSON output"""
+    return dict(next = page.next_cursor, prev = page.prev_cursor)
+
+def cached_fragment(name, tags, make, variant = None):
+    """html made by make(), cached per login state until one of tags is
+    invalidated by a model write
+    """
+    state = login_manager.user and 'user' or 'anon'
+    return Markup(fragment_cache.get_or_make(name, tags, make, (state, variant)))
+
+# Validators of conditional views, cached so that a 304 costs no query
+
+def home_version():
+    return fragment_cache.get_or_make('version:home', ('categories', 'items', 'images'),
+        lambda: Category.get_version() + Item.get_version() + (Image.get_version(),))
+
+def category_version(category_id):
+    return fragment_cache.get_or_make('version:category', ('category:%s' % category_id, 'images'),
+        lambda: Category.get_version(category_id) + Item.get_version(category_id) + (Image.get_version(),),
+        category_id)
+
+def item_version(category_id, item_id):
+    return fragment_cache.get_or_make('version:item', ('categories', 'items', 'images'),
+        lambda: Item.get_related_version(item_id), item_id)
+
+def categories_version():
+    return fragment_cache.get_or_make('version:categories', ('categories',), Category.get_version)
+
+def items_version(category_id):
+    return fragment_cache.get_or_make('version:items', ('category:%s' % category_id, 'images'),
+        lambda: Item.get_version(category_id) + (Image.get_version(),), category_id)
+
+def catalog_version():
+    return home_version()
+
 @app.route('/catalog/', methods = ['GET'])
+@conditional(home_version, private = True)
 def renderHomePage():
     """Catalog home page
     
-    It retrieves all categories and latest 10 items, then pass them to response
-    to render them. Items are listed in 2d list. 
-    In addtion, it initialize login_manager.
+    It retrieves all categories and one page of latest items, then pass them
+    to response to render them. Items are listed in 2d list. 
 
     Returns:
         render_page response
     """
-    login_manager.initialize()
-    categories = Category.get_all()
-    items = Item.get_latest_10_items()
+    category_list = cached_fragment('category_list', ('categories',),
+        lambda: render_page('categoryList.html', categories = Category.get_all()))
+    item_grid = cached_fragment('item_grid', ('items', 'images'), render_item_grid, request.query_string)
+    return render_page('catalog.html', category_list = category_list, item_grid = item_grid)
+
+def render_item_grid():
+    """Latest items grid of home page"""
+    page = Item.get_page(**page_args(HOME_PAGE_SIZE))
     # Create 2d array used for displaying in the html
     # Its size is 4 * rows
-    items_2d = []
     col_num = 4 # col_num % 12 = 0
-    for i in range(0, len(items), col_num):
-        temp = []
-        for j in range(i, min(len(items), i+col_num)):
-            temp.append(items[j])
-        items_2d.append(list(temp))
-    return render_page('catalog.html', categories = categories, items = items_2d, col_num = col_num)
+    items_2d = to_rows(page.items, col_num)
+    return render_page('itemGrid.html', items = items_2d, col_num = col_num, page = page)
 
 @app.route('/catalog/category_<int:category_id>/', methods = ['GET'])
+@conditional(category_version, private = True)
 def showCategory(category_id):
     """Show Category and all the items in it
 
@@ -61,22 +137,24 @@ def showCategory(category_id):
     Returns:
         render_page
     """
+    category_content = cached_fragment('category_content', ('category:%s' % category_id, 'images'),
+        lambda: render_category_content(category_id), (category_id, request.query_string))
+    return render_page('showCategory.html', category_content = category_content)
+
+def render_category_content(category_id):
+    """Category title, items grid and edit buttons"""
     category = Category.get_by_id(category_id)
-    items = Item.get_all_by_category(category_id)
+    page = Item.get_page(category_id = category_id, **page_args())
     # Create 2d array used for displaying in the html
     # Its size is 3 * rows
-    items_2d = []
     col_num = 3 # col_num % 12 = 0
-    for i in range(0, len(items), col_num):
-        temp = []
-        for j in range(i, min(len(items), i+3)):
-            temp.append(items[j])
-        items_2d.append(list(temp))
-    return render_page('showCategory.html', category = category, items = items_2d)
+    items_2d = to_rows(page.items, col_num)
+    return render_page('categoryContent.html', category = category, items = items_2d, page = page)
 
 
 @app.route('/catalog/newCategory/', methods = ['GET', 'POST'])
 @login_manager.login_required
+@transactional
 def newCategory():
     """Edit a new category
 
@@ -111,6 +189,7 @@ def newCategory():
 
 @app.route('/catalog/category_<int:category_id>/editCategory/', methods = ['GET', 'POST'])
 @login_manager.login_required
+@transactional
 def editCategory(category_id):
     """Edit an existing category
 
@@ -140,9 +219,8 @@ def editCategory(category_id):
 
         else:
             editingCategory.update(category_name)
-            # update all itmes of this category
-            for item in editingCategory.get_all_items():
-                item.update(category_id = editingCategory.id)
+            # items show the category name, touch all of them in one UPDATE
+            Item.update_by_category(editingCategory.id)
             return redirect('/catalog/category_%s' % editingCategory.id)
     else:
         return render_page('updateCategory.html', category = editingCategory)
@@ -150,6 +228,7 @@ def editCategory(category_id):
 # Delete a category
 @app.route('/catalog/category_<int:category_id>/deleteCategory', methods = ['POST']) 
 @login_manager.login_required
+@transactional
 def deleteCategory(category_id):
     """Delete an existing category
 
@@ -167,6 +246,7 @@ def deleteCategory(category_id):
             
 # Show an Item
 @app.route('/catalog/category_<int:category_id>/item_<int:item_id>', methods = ['GET'])
+@conditional(item_version, private = True)
 def showItem(category_id, item_id):
     """Show Item
 
@@ -178,13 +258,12 @@ def showItem(category_id, item_id):
         render_page if 'GET'
         redirect to show newly created category if 'POST'
     """
-    item = Item.get_by_id(item_id)
-    category = Category.get_by_id(category_id)
-    image = Image.get_by_id(item.img_id)
-    return render_page('showItem.html', item = item, category = category, image = image)
+    item = Item.get_with_related(item_id)
+    return render_page('showItem.html', item = item, category = item.category, image = item.image)
 
 @app.route('/catalog/category_<int:category_id>/newItem/', methods = ['GET', 'POST'])
 @login_manager.login_required
+@transactional
 def newItem(category_id):
     """Edit a new Item
 
@@ -211,6 +290,7 @@ def newItem(category_id):
 
 @app.route('/catalog/category_<int:category_id>/item_<int:item_id>/editItem/', methods = ['GET', 'POST'])
 @login_manager.login_required
+@transactional
 def editItem(category_id, item_id):
     """Edit an existing item
 
@@ -221,9 +301,9 @@ def editItem(category_id, item_id):
         render_page if 'GET'
         redirect to show changed category if 'POST'
     """
-    item = Item.get_by_id(item_id)
-    image = Image.get_by_id(item.img_id)
-    category = Category.get_by_id(category_id)
+    item = Item.get_with_related(item_id)
+    image = item.image
+    category = item.category
     categories = Category.get_all()
     if request.method == 'POST':
         img_title = None
@@ -239,6 +319,7 @@ def editItem(category_id, item_id):
 # Delete an item
 @app.route('/catalog/category_<int:category_id>/item_<int:item_id>/deleteItem', methods = ['POST'])
 @login_manager.login_required
+@transactional
 def deleteItem(category_id, item_id):
     """Delete an existing item
 
@@ -258,51 +339,69 @@ def deleteItem(category_id, item_id):
 
 @app.route('/catalog/search', methods = ['GET'])
 def search():
-    """Search full name in database"""
-    q = request.args.get('q')
-    item = Item.get_by_title(q)
-    category = None
-    if item:
-        category = Category.get_by_id(item.category_id)
+    """Search items and categories
+
+    Terms of 'q' are matched by prefix and with one typo allowed against item
+    titles, descriptions and category names. 'p' is the page number.
+    """
+    q = request.args.get('q', '')
+    p = request.args.get('p', 1, type = int)
+    result, items, categories = Item.search(q, p)
+    col_num = 3 # col_num % 12 = 0
+    return render_page('searchResult.html', q = q, result = result, items = to_rows(items, col_num),
+                       categories = categories)
 
-    return render_page('searchResult.html', category = category, item = item)
+@app.route('/catalog/suggest', methods = ['GET'])
+def suggest():
+    """Autocomplete item titles and category names starting with 'q'
+
+    'k' is the max number of suggestions. Served from memory, no query.
+    """
+    q = request.args.get('q', '')
+    k = max(1, min(request.args.get('k', SUGGEST_SIZE, type = int), SUGGEST_MAX_SIZE))
+    suggestions = [dict(kind = kind, id = row_id, name = name)
+                   for kind, row_id, name in search_index.suggest(q, k)]
+    return json_response(dict(Suggestions = suggestions))
 
 # add url_rule to Login
 app.add_url_rule('/catalog/login/', 'login', login_manager.login, methods = ['GET', 'POST'])
 
 # add url_rule to Signup
-app.add_url_rule('/catalog/signup/', 'signup', login_manager.signup, methods = ['GET', 'POST'])
+app.add_url_rule('/catalog/signup/', 'signup', transactional(login_manager.signup), methods = ['GET', 'POST'])
 
 # add url_rule to Logout
 app.add_url_rule('/catalog/logout/', 'logout', login_manager.logout, methods = ['GET'])
 
 # JSON 
 @app.route('/catalog.json')
+@conditional(categories_version)
 def categories_json():
-    """Categories JSON output"""
-    categories = Category.get_all()
-    return jsonify(Categories=[c.serialize for c in categories])
+    """Categories JSON output, paginated by 'after'/'before' cursors"""
+    page = Category.get_serialized_page(**page_args(JSON_PAGE_SIZE, JSON_MAX_PAGE_SIZE))
+    return json_response(dict(Categories=page.items, Page=page_json(page)))
 
 @app.route('/catalog/category_<int:category_id>.json')
+@conditional(items_version)
 def items_json(category_id):
-    """Items JSON output"""
-    items = Item.get_all_by_category(category_id)
-    return jsonify(Items=[i.serialize for i in items])
+    """Items JSON output, paginated by 'after'/'before' cursors"""
+    page = Item.get_serialized_page(category_id = category_id, **page_args(JSON_PAGE_SIZE, JSON_MAX_PAGE_SIZE))
+    return json_response(dict(Items=page.items, Page=page_json(page)))
 
 @app.route('/catalog/category_<int:category_id>/item_<int:item_id>.json')
+@conditional(item_version)
 def item_json(category_id, item_id):
     """Single item JSON output"""
-    item = Item.get_by_id(item_id)
-    return jsonify(Item=item.serialize)
+    return json_response(dict(Item=Item.get_serialized(item_id)))
     
 # XML
 @app.route('/catalog.xml')
+@conditional(catalog_version)
 def categories_xml():
-    """Categories XML output"""
-    categories = Category.get_all()
-    categories_xml = render_template('catalog.xml', categories = categories)
-    response = make_response(categories_xml)
-    response.headers["Content-Type"] = "application/xml"
-    return response
-
-    
+    """Full catalog XML output, streamed"""
+    return Response(stream_with_context(catalogExport.iter_xml()), mimetype = 'application/xml')
+
+@app.route('/catalog/export.json')
+@conditional(catalog_version)
+def catalog_export_json():
+    """Full catalog JSON output with all items, streamed"""
+    return Response(stream_with_context(catalogExport.iter_json()), mimetype = 'application/json')
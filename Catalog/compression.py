@@ -0,0 +1,197 @@
+"""
+Compression of text responses, as WSGI middleware.
+
+JSON, XML, HTML and other text responses of 200 OK are compressed with
+brotli, when the brotli module is installed and the client accepts it, or
+with gzip. Bodies with a Content-Length are compressed in one go, if they
+are at least COMPRESS_MIN_SIZE bytes. Streamed bodies, like the exports, are
+compressed chunk by chunk and flushed after each chunk, so the client still
+gets the first rows as soon as they are read.
+
+A response with an ETag always has the same body, so its compressed body is
+kept in a per-process cache, keyed by url, ETag and encoding. When a later
+response has the same ETag, the cached body is sent and the app's body is
+closed unread. For the streamed exports the rows are then never queried.
+"""
+
+import threading
+import zlib
+from collections import OrderedDict
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+import config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/xml',
+                      'application/javascript', 'image/svg+xml')
+
+class BodyCache(object):
+    """Compressed bodies, least recently used are dropped first
+
+    Attributes:
+        max_bytes: max total size of the bodies
+        max_entry: bodies larger than this are not kept
+        hits, misses: counters since start
+    """
+    def __init__(self, max_bytes, max_entry):
+        self.max_bytes = max_bytes
+        self.max_entry = max_entry
+        self.size = 0
+        self.entries = OrderedDict() # key -> body
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            body = self.entries.pop(key, None)
+            if body is None:
+                self.misses += 1
+                return None
+            self.entries[key] = body # most recently used goes last
+            self.hits += 1
+            return body
+
+    def set(self, key, body):
+        if len(body) > self.max_entry:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self.size -= len(self.entries.popitem(last = False)[1])
+
+class GzipCompressor(object):
+    """Streaming gzip, same interface as brotli.Compressor"""
+    def __init__(self):
+        self.z = zlib.compressobj(config.COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def process(self, data):
+        return self.z.compress(data)
+
+    def flush(self):
+        return self.z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.z.flush(zlib.Z_FINISH)
+
+def new_compressor(encoding):
+    if encoding == 'br':
+        return brotli.Compressor(quality = config.COMPRESS_BROTLI_QUALITY)
+    return GzipCompressor()
+
+def choose_encoding(accept_encoding):
+    """'br', 'gzip' or None, by the Accept-Encoding header"""
+    accept = parse_accept_header(accept_encoding)
+    encodings = brotli and ('br', 'gzip') or ('gzip',)
+    best = max(encodings, key = lambda e: accept.quality(e)) # first one on a tie
+    return accept.quality(best) > 0 and best or None
+
+def is_compressible(status, headers):
+    content_type = headers.get('Content-Type', '')
+    return status.startswith('200') and content_type.startswith(COMPRESSIBLE_TYPES) and \
+        'Content-Encoding' not in headers and \
+        'no-transform' not in headers.get('Cache-Control', '')
+
+def closing(app_iter):
+    if hasattr(app_iter, 'close'):
+        app_iter.close()
+
+def iter_compressed(app_iter, encoding, cache, cache_key):
+    """Compress app_iter chunk by chunk, and cache the result if cache_key"""
+    compressor = new_compressor(encoding)
+    kept = cache_key and []
+    kept_size = 0
+    try:
+        for chunk in app_iter:
+            if not chunk:
+                continue
+            data = compressor.process(chunk) + compressor.flush()
+            if kept is not None and kept_size + len(data) <= cache.max_entry:
+                kept.append(data)
+                kept_size += len(data)
+            else:
+                kept = None
+            yield data
+        data = compressor.finish()
+        yield data
+        if kept is not None:
+            kept.append(data)
+            cache.set(cache_key, b''.join(kept))
+    finally:
+        closing(app_iter)
+
+class Compressor(object):
+    """WSGI middleware compressing the responses of app
+
+    write() of start_response is not supported, the app must return its body.
+    """
+    def __init__(self, app, cache = None):
+        self.app = app
+        self.cache = cache or BodyCache(config.COMPRESS_CACHE_SIZE, config.COMPRESS_CACHE_MAX_ENTRY)
+
+    def __call__(self, environ, start_response):
+        captured = []
+        def capture(status, headers, exc_info = None):
+            captured[:] = [status, headers, exc_info]
+        app_iter = self.app(environ, capture)
+        status, headers, exc_info = captured
+        headers = Headers(headers)
+
+        if not is_compressible(status, headers):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return app_iter
+        vary = headers.get('Vary')
+        if not vary:
+            headers['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower():
+            headers['Vary'] = vary + ', Accept-Encoding'
+
+        encoding = environ['REQUEST_METHOD'] == 'GET' and \
+            choose_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        length = headers.get('Content-Length', type = int)
+        if not encoding or (length is not None and length < config.COMPRESS_MIN_SIZE):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return app_iter
+
+        headers['Content-Encoding'] = encoding
+        headers.pop('Accept-Ranges', None) # ranges of the compressed body are not served
+        etag = headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            # the compressed body differs byte for byte
+            headers['ETag'] = 'W/' + etag
+        cache_key = etag and (environ.get('PATH_INFO'), environ.get('QUERY_STRING'), etag, encoding)
+
+        body = cache_key and self.cache.get(cache_key)
+        if body is None and length is not None and length <= self.cache.max_entry:
+            try:
+                compressor = new_compressor(encoding)
+                body = b''.join(compressor.process(chunk) for chunk in app_iter) + compressor.finish()
+            finally:
+                closing(app_iter)
+            if cache_key:
+                self.cache.set(cache_key, body)
+        elif body is not None:
+            closing(app_iter)
+
+        if body is not None:
+            headers['Content-Length'] = str(len(body))
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return [body]
+        headers.pop('Content-Length', None)
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        return iter_compressed(app_iter, encoding, self.cache, cache_key)
+
+def init_app(app):
+    """Compress the responses of app"""
+    if config.COMPRESS_ENABLED:
+        app.wsgi_app = Compressor(app.wsgi_app)
@@ -0,0 +1,73 @@
+"""
+Conditional GET support.
+
+A view decorated with conditional() first asks its validator for the
+versions of the rows it displays, which are cheap aggregates of their
+datetime columns. If the client already has the response of those versions
+(If-None-Match, or If-Modified-Since when no ETag is sent), 304 is returned
+before anything is queried, rendered or serialized.
+"""
+
+import hashlib
+from functools import wraps
+
+from flask import make_response, request
+
+def make_etag(values):
+    """ETag of the request url and the validator values"""
+    key = repr((request.path, request.query_string, tuple(values)))
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+def last_modified_of(values):
+    """Latest datetime among values, None if there is none"""
+    dts = [v for v in values if hasattr(v, 'utctimetuple')]
+    return dts and max(dts).replace(microsecond = 0) or None
+
+def is_not_modified(etag, last_modified):
+    """Check the request validators against the current ones"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    ims = request.if_modified_since
+    if ims and last_modified:
+        return last_modified <= ims.replace(tzinfo = None)
+    return False
+
+def set_validators(response, etag, last_modified, private):
+    response.set_etag(etag, weak = True)
+    if last_modified and not private:
+        response.last_modified = last_modified
+    if private:
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+    else:
+        response.headers['Cache-Control'] = 'public, no-cache'
+    return response
+
+def conditional(validator, private = False):
+    """Decorator answering 304 Not Modified when the data hasn't changed
+
+    Args:
+        validator: function taking the view arguments and returning a list of
+            values, e.g. datetimes and counts, that change whenever the
+            response changes
+        private: the response depends on the logged in user. The user_id
+            cookie is then part of the ETag, and no Last-Modified is sent
+            because it can't tell a login or logout.
+    """
+    def decorator(func):
+        @wraps(func)
+        def conditional_view(*a, **kw):
+            values = list(validator(*a, **kw))
+            if private:
+                values.append(request.cookies.get('user_id'))
+            etag = make_etag(values)
+            last_modified = last_modified_of(values)
+            if is_not_modified(etag, None if private else last_modified):
+                response = make_response('', 304)
+            else:
+                response = make_response(func(*a, **kw))
+                if response.status_code != 200:
+                    return response
+            return set_validators(response, etag, last_modified, private)
+        return conditional_view
+    return decorator
@@ -0,0 +1,90 @@
+"""
+App settings.
+
+Every setting can be overridden by an environment variable of the same name
+prefixed with "CATALOG_", e.g. CATALOG_DATABASE_URL=sqlite:///catalog.db
+"""
+
+import os
+
+def setting(name, default):
+    """Read CATALOG_<name> from environment, converted to the type of default"""
+    val = os.environ.get('CATALOG_' + name)
+    if val is None:
+        return default
+    if isinstance(default, bool):
+        return val.lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, int):
+        return int(val)
+    if isinstance(default, float):
+        return float(val)
+    return val
+
+# Database
+DATABASE_URL = setting('DATABASE_URL', 'postgresql+psycopg2:///catalog')
+DB_POOL_SIZE = setting('DB_POOL_SIZE', 10) # connections kept open per process
+DB_MAX_OVERFLOW = setting('DB_MAX_OVERFLOW', 10) # extra connections under load
+DB_POOL_TIMEOUT = setting('DB_POOL_TIMEOUT', 30) # seconds to wait for a connection
+DB_POOL_RECYCLE = setting('DB_POOL_RECYCLE', 1800) # seconds before reconnecting
+DB_POOL_PRE_PING = setting('DB_POOL_PRE_PING', True) # test connections on checkout
+DB_SLOW_CHECKOUT = setting('DB_SLOW_CHECKOUT', 0.1) # log checkouts waiting longer
+# psycopg2 executemany: 'values' sends many INSERT rows per statement
+DB_EXECUTEMANY_MODE = setting('DB_EXECUTEMANY_MODE', 'values')
+# Read replicas, comma separated urls, e.g. postgresql:///catalog_replica
+DATABASE_REPLICA_URLS = setting('DATABASE_REPLICA_URLS', '')
+DB_REPLICA_CHECK_INTERVAL = setting('DB_REPLICA_CHECK_INTERVAL', 5.0) # seconds between health checks
+DB_REPLICA_CONNECT_TIMEOUT = setting('DB_REPLICA_CONNECT_TIMEOUT', 2) # seconds to connect to a replica
+DB_REPLICA_MAX_LAG = setting('DB_REPLICA_MAX_LAG', 10.0) # seconds of PostgreSQL replay lag, 0 to ignore
+DB_STICKY_PRIMARY_SECONDS = setting('DB_STICKY_PRIMARY_SECONDS', 5) # a client reads from the primary after a write
+
+# Login
+USER_CACHE_SIZE = setting('USER_CACHE_SIZE', 10000) # user records cached per process
+USER_CACHE_TTL = setting('USER_CACHE_TTL', 60) # seconds a user record is cached
+
+# Import
+IMPORT_BATCH_SIZE = setting('IMPORT_BATCH_SIZE', 1000) # rows inserted per transaction
+IMPORT_IMAGE_WORKERS = setting('IMPORT_IMAGE_WORKERS', 8) # concurrent image downloads
+
+# Query statistics
+QUERY_STATS = setting('QUERY_STATS', True) # time the statements of each request
+QUERY_SERVER_TIMING = setting('QUERY_SERVER_TIMING', True) # send them in a Server-Timing header
+QUERY_REPEAT_THRESHOLD = setting('QUERY_REPEAT_THRESHOLD', 5) # repeats logged as possible N+1
+QUERY_SLOWEST = setting('QUERY_SLOWEST', 3) # slowest statements logged per request
+
+# Metrics
+METRICS_ENABLED = setting('METRICS_ENABLED', True) # record requests and serve /metrics
+METRICS_DIR = setting('METRICS_DIR', '') # folder shared by worker processes, empty at startup
+
+# Fragment cache
+CACHE_TAG_DIR = setting('CACHE_TAG_DIR', '') # folder sharing tag versions between processes, see fragmentCache.py
+
+# Image serving
+IMAGE_URL_PREFIX = setting('IMAGE_URL_PREFIX', '/images/') # route of stored images, empty for /static
+IMAGE_MAX_AGE = setting('IMAGE_MAX_AGE', 31536000) # seconds fingerprinted images are cached
+# '' sends files from the app, 'X-Accel-Redirect' (nginx) or 'X-Sendfile'
+# (Apache, lighttpd) lets the front server send them
+IMAGE_SENDFILE_HEADER = setting('IMAGE_SENDFILE_HEADER', '')
+IMAGE_ACCEL_PREFIX = setting('IMAGE_ACCEL_PREFIX', '/protected-images/') # nginx internal location
+
+# Compression
+COMPRESS_ENABLED = setting('COMPRESS_ENABLED', True) # gzip or brotli text responses
+COMPRESS_MIN_SIZE = setting('COMPRESS_MIN_SIZE', 1024) # bytes, smaller bodies are sent as is
+COMPRESS_GZIP_LEVEL = setting('COMPRESS_GZIP_LEVEL', 6)
+COMPRESS_BROTLI_QUALITY = setting('COMPRESS_BROTLI_QUALITY', 5)
+COMPRESS_CACHE_SIZE = setting('COMPRESS_CACHE_SIZE', 64 * 1024 * 1024) # bytes of compressed bodies kept per process
+COMPRESS_CACHE_MAX_ENTRY = setting('COMPRESS_CACHE_MAX_ENTRY', 8 * 1024 * 1024) # larger bodies are not kept
+
+# Production server (serve.py)
+SERVER_BIND = setting('SERVER_BIND', '0.0.0.0:8000')
+SERVER_WORKERS = setting('SERVER_WORKERS', 0) # processes, 0 for 2 * CPUs + 1
+SERVER_THREADS = setting('SERVER_THREADS', 4) # threads per process
+SERVER_MAX_REQUESTS = setting('SERVER_MAX_REQUESTS', 10000) # a worker is replaced after this many requests, 0 never
+SERVER_MAX_REQUESTS_JITTER = setting('SERVER_MAX_REQUESTS_JITTER', 1000) # so workers are not replaced all at once
+SERVER_TIMEOUT = setting('SERVER_TIMEOUT', 30) # seconds a silent worker is given before it is killed
+SERVER_GRACEFUL_TIMEOUT = setting('SERVER_GRACEFUL_TIMEOUT', 30) # seconds to finish requests on reload or stop
+SERVER_KEEPALIVE = setting('SERVER_KEEPALIVE', 5) # seconds an idle keep-alive connection is kept
+SERVER_PRELOAD = setting('SERVER_PRELOAD', False) # import the app once before forking, HUP then can't reload code
+
+# Startup
+TEMPLATE_BYTECODE_CACHE = setting('TEMPLATE_BYTECODE_CACHE', True) # compile templates once per host
+TEMPLATE_CACHE_DIR = setting('TEMPLATE_CACHE_DIR', '') # empty for a folder in the temp dir
@@ -0,0 +1,332 @@
+"""
+Database engine and sessions.
+
+There is one engine per process, created by get_engine() on first use, so
+importing the app doesn't connect to the database. Its connection pool is
+configured in config.py and records how long checkouts wait for a free
+connection. The tables are created by "python Catalog/migrations.py".
+
+'session' is a scoped_session: every thread gets its own session, which is
+closed by remove_session at the end of each request.
+
+Model methods save changes with commit(). Inside unit_of_work() it only
+flushes, and the unit of work commits once at its end, or rolls back if an
+exception is raised. Side effects which must only happen once the data is
+committed, like updating indexes or caches, are registered with
+after_commit().
+
+With DATABASE_REPLICA_URLS set, reads go to a replica engine and everything
+else goes to the primary. Each session reads from one replica, picked
+round-robin among the healthy ones, so the pages of a request are consistent
+with each other; it picks another one if its replica fails. A session sticks to the primary once it writes or enters a unit of work, so
+the rest of the request reads its own writes. The response then sets a
+cookie that keeps the same client on the primary for
+DB_STICKY_PRIMARY_SECONDS, enough for a replica to catch up, so the page
+shown after a redirect is not stale.
+"""
+
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import request
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session, sessionmaker, scoped_session
+from sqlalchemy.sql.expression import Select
+from sqlalchemy.pool import QueuePool, StaticPool
+
+import config
+
+class TimedQueuePool(QueuePool):
+    """QueuePool recording the time spent waiting in checkouts"""
+    def __init__(self, *a, **kw):
+        QueuePool.__init__(self, *a, **kw)
+        self.stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            wait = time.time() - start
+            with self.stats_lock:
+                self.checkouts += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            if wait > config.DB_SLOW_CHECKOUT:
+                logging.warning('waited %.3fs for a database connection', wait)
+
+def make_engine(url = None, connect_timeout = None):
+    """Create an engine with the pool settings of config.py
+
+    SQLite is supported for tests and local runs: a file database is shared
+    by threads, an in-memory one uses a single connection.
+
+    Args:
+        connect_timeout: seconds to wait for a new PostgreSQL connection
+    """
+    url = make_url(url or config.DATABASE_URL)
+    kw = dict(poolclass = TimedQueuePool,
+              pool_size = config.DB_POOL_SIZE,
+              max_overflow = config.DB_MAX_OVERFLOW,
+              pool_timeout = config.DB_POOL_TIMEOUT,
+              pool_recycle = config.DB_POOL_RECYCLE,
+              pool_pre_ping = config.DB_POOL_PRE_PING)
+    if url.drivername in ('postgresql', 'postgresql+psycopg2'):
+        kw['executemany_mode'] = config.DB_EXECUTEMANY_MODE
+        if connect_timeout:
+            kw['connect_args'] = dict(connect_timeout = connect_timeout)
+    if url.drivername.startswith('sqlite'):
+        kw['connect_args'] = dict(check_same_thread = False)
+        if url.database in (None, '', ':memory:'):
+            kw = dict(poolclass = StaticPool, connect_args = kw['connect_args'])
+    return create_engine(url, **kw)
+
+def pool_stats(pool = None):
+    """Connection pool state and checkout wait times
+
+    Returns:
+        dict with size, checked_out, overflow, checkouts, wait_total
+        and wait_max (seconds)
+    """
+    pool = pool or get_engine().pool
+    stats = dict(size = pool.size(), checked_out = pool.checkedout(),
+                 overflow = max(0, pool.overflow()))
+    stats.update(checkouts = getattr(pool, 'checkouts', 0),
+                 wait_total = getattr(pool, 'wait_total', 0.0),
+                 wait_max = getattr(pool, 'wait_max', 0.0))
+    return stats
+
+class ReplicaSet(object):
+    """Replica engines handed out round-robin, skipping unhealthy ones
+
+    A background thread of each process checks the replicas every
+    DB_REPLICA_CHECK_INTERVAL seconds, so requests never wait for a check.
+    A replica is healthy if it accepts a connection and, on PostgreSQL,
+    replays the primary's changes less than DB_REPLICA_MAX_LAG seconds
+    late. A replica whose connection breaks is unhealthy until the next check.
+    """
+    def __init__(self, engines):
+        self.engines = engines
+        self.healthy = dict((e, True) for e in engines)
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.checker_pid = None
+        self.checker = None
+        self.stopped = threading.Event()
+        for e in engines:
+            event.listen(e, 'handle_error', self.handle_error)
+
+    def pick(self):
+        """Next healthy replica, None if there is none"""
+        self.start_checker()
+        healthy = [e for e in self.engines if self.healthy[e]]
+        if not healthy:
+            return None
+        return healthy[next(self.counter) % len(healthy)]
+
+    def start_checker(self):
+        """Start the checking thread of this process, if it isn't running
+
+        Threads don't survive a fork, so a worker starts its own.
+        """
+        if self.checker_pid == os.getpid():
+            return
+        with self.lock:
+            if self.checker_pid == os.getpid():
+                return
+            self.checker_pid = os.getpid()
+            self.checker = threading.Thread(target = self.run_checker, name = 'replica-checker')
+            self.checker.daemon = True
+            self.checker.start()
+
+    def run_checker(self):
+        while not self.stopped.is_set():
+            self.check_all()
+            self.stopped.wait(config.DB_REPLICA_CHECK_INTERVAL)
+
+    def stop_checker(self):
+        """Stop the checking thread of this process and wait for it"""
+        self.stopped.set()
+        if self.checker_pid == os.getpid():
+            self.checker.join()
+
+    def check_all(self):
+        for engine in self.engines:
+            self.healthy[engine] = self.check(engine)
+
+    def check(self, engine):
+        try:
+            with engine.connect() as conn:
+                if engine.dialect.name == 'postgresql' and config.DB_REPLICA_MAX_LAG:
+                    # NULL on a primary, 0 on a replica with nothing left to replay
+                    lag = conn.execute(
+                        'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+                        'ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END').scalar()
+                    if lag is not None and lag > config.DB_REPLICA_MAX_LAG:
+                        logging.warning('replica %s is %.1fs behind, reading from others', engine.url, lag)
+                        return False
+                else:
+                    conn.execute('SELECT 1')
+        except SQLAlchemyError as e:
+            logging.warning('replica %s is unavailable: %s', engine.url, e)
+            return False
+        return True
+
+    def handle_error(self, context):
+        if context.is_disconnect and context.engine in self.healthy:
+            self.healthy[context.engine] = False
+
+class RoutingSession(Session):
+    """Session reading from one replica until it writes
+
+    Statements go to the primary engine when use_primary was called on the
+    session, when they are not a plain SELECT or when no replica is
+    healthy. Any of them but the last makes the session stick to the primary.
+    The replica is kept in info['replica'] until it becomes unhealthy.
+    """
+    def get_bind(self, mapper = None, clause = None, **kw):
+        replicas = get_replicas()
+        if replicas is None:
+            return get_engine()
+        if self._flushing or not isinstance(clause, Select) or clause._for_update_arg is not None:
+            use_primary(self)
+            self.info['wrote'] = True
+        if self.info.get('use_primary'):
+            return get_engine()
+        replica = self.info.get('replica')
+        if replica is None or not replicas.healthy[replica]:
+            replica = self.info['replica'] = replicas.pick()
+        return replica or get_engine()
+
+def use_primary(sess = None):
+    """Send every further statement of the session to the primary"""
+    (session if sess is None else sess).info['use_primary'] = True
+
+_engine = None
+_replicas = None
+_engines_lock = threading.Lock()
+
+def get_engine():
+    """The primary engine, created on first use"""
+    global _engine
+    if _engine is None:
+        with _engines_lock:
+            if _engine is None:
+                _engine = make_engine()
+    return _engine
+
+def get_replicas():
+    """ReplicaSet of DATABASE_REPLICA_URLS created on first use, None if there is none"""
+    global _replicas
+    if _replicas is None and config.DATABASE_REPLICA_URLS:
+        with _engines_lock:
+            if _replicas is None:
+                _replicas = ReplicaSet([make_engine(url.strip(), config.DB_REPLICA_CONNECT_TIMEOUT)
+                                        for url in config.DATABASE_REPLICA_URLS.split(',') if url.strip()])
+    return _replicas
+
+def all_engines():
+    """The engines created so far, primary first"""
+    return [e for e in [_engine] if e is not None] + (_replicas and _replicas.engines or [])
+
+def dispose_engines():
+    """Close the pooled connections of all engines
+
+    Called before and after forking worker processes, so no process uses a
+    connection opened by another one.
+    """
+    for e in all_engines():
+        e.dispose()
+
+def in_unit_of_work():
+    return session.info.get('unit_of_work', False)
+
+def after_commit(func, *a):
+    """Call func(*a) after the unit of work commits, or now if there is none"""
+    if in_unit_of_work():
+        session.info['after_commit'].append((func, a))
+    else:
+        func(*a)
+
+def commit():
+    """Commit the session, or only flush it inside a unit of work"""
+    if in_unit_of_work():
+        session.flush()
+    else:
+        session.commit()
+
+@contextmanager
+def unit_of_work():
+    """Commit all changes made inside the block in one transaction
+
+    Nested units of work join the outer one. On exception the transaction
+    is rolled back and the after_commit callbacks are dropped.
+    """
+    if in_unit_of_work():
+        yield
+        return
+    session.info['unit_of_work'] = True
+    use_primary() # reads inside the unit of work must see its writes
+    session.info['after_commit'] = []
+    try:
+        yield
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.info['unit_of_work'] = False
+        callbacks = session.info.pop('after_commit')
+    for func, a in callbacks:
+        func(*a)
+
+def transactional(func):
+    """Decorator running a view in a unit of work"""
+    @wraps(func)
+    def transactional_view(*a, **kw):
+        with unit_of_work():
+            return func(*a, **kw)
+    return transactional_view
+
+def remove_session(exception = None):
+    """Close the session of this thread, registered as teardown_appcontext"""
+    session.remove()
+
+# Sticky primary
+
+STICKY_COOKIE = 'db_primary'
+
+def stick_to_primary():
+    """before_request: use the primary if this client wrote recently"""
+    try:
+        until = float(request.cookies.get(STICKY_COOKIE, 0))
+    except ValueError:
+        return
+    if until > time.time():
+        use_primary()
+
+def set_sticky_cookie(response):
+    """after_request: keep the client on the primary if the request wrote"""
+    if session.info.get('wrote') and config.DB_STICKY_PRIMARY_SECONDS:
+        response.set_cookie(STICKY_COOKIE, '%d' % (time.time() + config.DB_STICKY_PRIMARY_SECONDS),
+                            max_age = config.DB_STICKY_PRIMARY_SECONDS, httponly = True)
+    return response
+
+def init_app(app):
+    """Keep clients which wrote on the primary, if there are replicas"""
+    if config.DATABASE_REPLICA_URLS:
+        app.before_request(stick_to_primary)
+        app.after_request(set_sticky_cookie)
+
+DBSession = sessionmaker(class_ = RoutingSession)
+session = scoped_session(DBSession)
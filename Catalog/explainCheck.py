@@ -0,0 +1,123 @@
+"""
+Check that the model queries use indexes.
+
+    python Catalog/explainCheck.py [-v]
+
+Every query issued by the read methods of the models is captured and run
+again under EXPLAIN. The check fails if a plan reads a table by a sequential
+scan, unless the method reads the whole table by design. On PostgreSQL
+enable_seqscan is turned off, so a sequential scan is only planned when no
+index can serve the query. SQLite plans come from EXPLAIN QUERY PLAN.
+
+Run it after migrations.py upgrade, and preferably on a database with
+realistic data.
+"""
+
+import collections
+import datetime
+import re
+import sys
+
+from sqlalchemy import event
+from sqlalchemy.orm.exc import NoResultFound
+
+from catalogDB import Base, Category, Item, Image, User, encode_cursor
+from database import get_engine, session
+
+Position = collections.namedtuple('Position', 'datetime id')
+
+def model_queries(category_id, item_id, image_id, user_id):
+    """(name, function, full table) of the read methods
+
+    full table is True if the method reads the whole table by design.
+    """
+    cursor = encode_cursor(Position(datetime.datetime.now(), item_id))
+    return [
+        ('Category.get_by_id', lambda: Category.get_by_id(category_id), False),
+        ('Category.get_by_name', lambda: Category.get_by_name('name'), False),
+        ('Category.get_all', lambda: Category.get_all(), True),
+        ('Category.get_version', lambda: Category.get_version(), False),
+        ('Category.get_version(category)', lambda: Category.get_version(category_id), False),
+        ('Category.get_page', lambda: Category.get_page(), False),
+        ('Category.get_page(after)', lambda: Category.get_page(after = cursor), False),
+        ('Category.get_serialized_page', lambda: Category.get_serialized_page(before = cursor), False),
+        ('Item.get_by_id', lambda: Item.get_by_id(item_id), False),
+        ('Item.get_with_related', lambda: Item.get_with_related(item_id), False),
+        ('Item.get_by_title', lambda: Item.get_by_title('title'), False),
+        ('Item.get_all_by_category', lambda: Item.get_all_by_category(category_id), False),
+        ('Item.get_version', lambda: Item.get_version(), False),
+        ('Item.get_version(category)', lambda: Item.get_version(category_id), False),
+        ('Item.get_related_version', lambda: Item.get_related_version(item_id), False),
+        ('Item.get_page', lambda: Item.get_page(), False),
+        ('Item.get_page(category)', lambda: Item.get_page(category_id), False),
+        ('Item.get_page(category, after)', lambda: Item.get_page(category_id, after = cursor), False),
+        ('Item.get_latest_10_items', lambda: Item.get_latest_10_items(), False),
+        ('Item.get_serialized_page', lambda: Item.get_serialized_page(category_id), False),
+        ('Item.get_serialized', lambda: Item.get_serialized(item_id), False),
+        ('Image.get_by_id', lambda: Image.get_by_id(image_id), False),
+        ('Image.get_version', lambda: Image.get_version(), False),
+        ('User.get_by_name', lambda: User.get_by_name('name'), False),
+        ('User.get_by_id', lambda: User.get_by_id(user_id), False),
+    ]
+
+def capture(func):
+    """Run func and return the (statement, parameters) it executed"""
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+    event.listen(get_engine(), 'before_cursor_execute', before_cursor_execute)
+    try:
+        func()
+    except NoResultFound:
+        pass
+    finally:
+        event.remove(get_engine(), 'before_cursor_execute', before_cursor_execute)
+    return statements
+
+def explain(conn, statement, parameters):
+    """Plan lines of a statement and the tables it scans sequentially"""
+    cursor = conn.cursor()
+    if get_engine().dialect.name == 'postgresql':
+        cursor.execute('SET enable_seqscan = off')
+        cursor.execute('EXPLAIN ' + statement, parameters)
+        lines = [row[0] for row in cursor.fetchall()]
+        scans = [m.group(1) for m in (re.search(r'Seq Scan on "?(\w+)"?', l) for l in lines) if m]
+    else:
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        lines = [row[-1] for row in cursor.fetchall()]
+        # "SCAN TABLE item" or "SCAN item", not "SCAN item USING INDEX ..."
+        scans = [m.group(1) for m in (re.match(r'SCAN (?:TABLE )?"?(\w+)"?\s*$', l) for l in lines) if m]
+    cursor.close()
+    return lines, [t for t in scans if t in Base.metadata.tables]
+
+def sample_id(model):
+    return session.query(model.id).limit(1).scalar() or 1
+
+def main(argv = None):
+    argv = sys.argv[1:] if argv is None else argv
+    verbose = '-v' in argv
+    queries = model_queries(sample_id(Category), sample_id(Item), sample_id(Image), sample_id(User))
+    failed = []
+    conn = get_engine().raw_connection()
+    try:
+        for name, func, full_table in queries:
+            for statement, parameters in capture(func):
+                lines, scans = explain(conn, statement, parameters)
+                if scans and not full_table:
+                    failed.append(name)
+                    print('FAIL %s: sequential scan of %s' % (name, ', '.join(scans)))
+                elif verbose:
+                    print('ok   %s' % name)
+                if verbose or (scans and not full_table):
+                    for line in [statement] + lines:
+                        print('       ' + ' '.join(line.split()))
+        conn.rollback()
+    finally:
+        conn.close()
+        session.remove()
+    print('%d queries checked, %d with sequential scans' % (len(queries), len(set(failed))))
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
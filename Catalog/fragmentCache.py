@@ -0,0 +1,218 @@
+"""
+Cache of rendered page fragments and other derived values.
+
+Every entry is stored with tags naming the tables it was made from, like
+'categories' or 'category:3'. Model write methods invalidate their tags, so
+an entry is only rebuilt when its data has changed.
+
+Invalidation doesn't delete entries. Each tag has a version token, the
+tokens are part of the entry keys, and invalidating a tag replaces its token.
+Stale entries are never read again and age out of the backend. This works
+the same way with a shared backend, where entries can't be enumerated.
+
+Entries and tag versions are kept in an in-process LRU by default. With
+several worker processes, tag versions must be shared, or a write would only
+invalidate the entries of the worker which made it: with CACHE_TAG_DIR set
+they are kept in files of that folder, read by every process of the host.
+
+With read replicas, a replica may not have the change behind an invalidation
+yet. A lookup of a tag invalidated less than DB_STICKY_PRIMARY_SECONDS ago
+sends the rest of the request to the primary, so the entry, and the response
+validators and compressed body made from it, are not filled with stale rows.
+"""
+
+import errno
+import hashlib
+import itertools
+import os
+import pickle
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import config
+from database import use_primary
+
+DEFAULT_TTL = 300 # seconds an entry is kept even if its tags don't change
+
+class LRUBackend(object):
+    """In-process backend, least recently used entries are dropped first
+
+    Only invalidations made in this process are seen, use SharedBackend when
+    several processes serve the app.
+
+    Attributes:
+        max_entries: max number of entries
+    """
+    def __init__(self, max_entries = 1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (expire time, value)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] and entry[0] < time.time():
+                return None
+            self.entries[key] = entry # most recently used goes last
+            return entry[1]
+
+    def set(self, key, value, ttl = 0):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (ttl and time.time() + ttl, value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last = False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+class SharedBackend(object):
+    """Backend shared by processes through a memcached-like client
+
+    Attributes:
+        client: object with get(key), set(key, value, time = ttl) and
+            delete(key), e.g. memcache.Client or pymemcache with a pickle
+            serializer. Any object with these methods can stand in for it.
+        prefix: prepended to every key
+    """
+    def __init__(self, client, prefix = 'catalog:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl = 0):
+        self.client.set(self.prefix + key, value, time = ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+class FileBackend(object):
+    """Backend shared by the processes of a host through the files of a folder
+
+    Meant for tag versions, which are small. Every key is a file, written to
+    a temporary file which is then renamed, so a reader never sees a partial
+    value. The ttl is ignored.
+
+    Attributes:
+        folder: folder of the files, created on first write
+    """
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path(self, key):
+        return os.path.join(self.folder, hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, EOFError):
+            return None
+
+    def set(self, key, value, ttl = 0):
+        try:
+            fd, tmp = tempfile.mkstemp(dir = self.folder, suffix = '.tmp')
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            try:
+                os.makedirs(self.folder)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            fd, tmp = tempfile.mkstemp(dir = self.folder, suffix = '.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+class FragmentCache(object):
+    """Tagged cache over a backend
+
+    Attributes:
+        backend: LRUBackend or SharedBackend
+        tag_backend: backend of the tag versions, 'backend' unless given
+        ttl: seconds an entry is kept
+        enabled: when False every get_or_make calls make
+        hits, misses: counters since start
+    """
+    def __init__(self, backend, ttl = DEFAULT_TTL, tag_backend = None):
+        self.backend = backend
+        self.tag_backend = tag_backend or backend
+        self.ttl = ttl
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self.stats_lock = threading.Lock()
+        self._counter = itertools.count()
+
+    def use(self, backend, tag_backend = None):
+        """Replace the backends, e.g. by a SharedBackend at startup"""
+        self.backend = backend
+        self.tag_backend = tag_backend or backend
+
+    def _new_token(self):
+        return '%s-%d' % (uuid.uuid4().hex[:12], next(self._counter))
+
+    def _tag_version(self, tag):
+        """Current (token, invalidation time) of a tag
+
+        A tag whose token was evicted or never set gets a new token, which
+        invalidates any entry made with an older one.
+        """
+        key = 'tag:' + tag
+        version = self.tag_backend.get(key)
+        if version is None:
+            version = (self._new_token(), 0)
+            self.tag_backend.set(key, version)
+        return version
+
+    def get_or_make(self, name, tags, make, variant = None):
+        """Return the cached value of name, or make and cache it
+
+        Args:
+            name: entry name, e.g. 'category_list'
+            tags: tags of the data the value is made from
+            make: function with no argument making the value
+            variant: anything else the value depends on, e.g. the login
+                state or the query string
+        """
+        if not self.enabled:
+            return make()
+        versions = [self._tag_version(tag) for tag in tags]
+        if config.DATABASE_REPLICA_URLS and \
+                max([0] + [t for _, t in versions]) > time.time() - config.DB_STICKY_PRIMARY_SECONDS:
+            use_primary() # replicas may lag behind the invalidation
+        key = 'frag:%s:%s:%s' % (name, variant, ':'.join(token for token, _ in versions))
+        value = self.backend.get(key)
+        with self.stats_lock:
+            if value is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if value is not None:
+            return value
+        value = make()
+        self.backend.set(key, value, self.ttl)
+        return value
+
+    def invalidate(self, *tags):
+        """Make every entry with one of the tags stale"""
+        for tag in tags:
+            self.tag_backend.set('tag:' + tag, (self._new_token(), time.time()))
+
+fragment_cache = FragmentCache(LRUBackend(), tag_backend = config.CACHE_TAG_DIR and
+                               FileBackend(config.CACHE_TAG_DIR) or None)
@@ -0,0 +1,245 @@
+"""
+Background image ingestion.
+
+Item views only record an image as pending and submit its url here. A fixed
+pool of worker threads downloads it, reusing keep-alive connections per host,
+with a timeout, a size limit and retries, puts it into the ImageStore and
+reports the result through a callback which marks the image row as ready or
+failed.
+"""
+
+import httplib
+import logging
+import os
+import Queue
+import socket
+import tempfile
+import threading
+import time
+import urlparse
+
+from imageStore import guess_ext, new_hash
+
+USER_AGENT = 'CatalogImageIngest/1.0'
+MAX_REDIRECTS = 3
+BLOCK_SIZE = 8192
+
+class IngestError(Exception):
+    """Download failed and retrying won't help"""
+    pass
+
+class ConnectionPool(object):
+    """Idle keep-alive connections, at most max_per_host for each host"""
+    def __init__(self, timeout, max_per_host = 2):
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        self.idle = {} # (scheme, netloc) -> list of connections
+        self.lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        with self.lock:
+            conns = self.idle.get((scheme, netloc))
+            if conns:
+                return conns.pop()
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout = self.timeout)
+        return httplib.HTTPConnection(netloc, timeout = self.timeout)
+
+    def put(self, scheme, netloc, conn):
+        with self.lock:
+            conns = self.idle.setdefault((scheme, netloc), [])
+            if len(conns) < self.max_per_host:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+class ImageIngestor(object):
+    """Bounded pool of download workers
+
+    Attributes:
+        store: ImageStore where downloaded files are put
+        on_done: callback(image_id, stored, error) called by the worker after
+            the last attempt. stored is a StoredImage, or None if the
+            download failed, then error is the error message.
+        workers: number of worker threads
+        max_queue: max number of waiting downloads, submit fails beyond it
+        timeout: socket timeout in seconds
+        max_bytes: max size of an image
+        retries: attempts after the first failed one
+        backoff: seconds before the first retry, doubled for each retry
+    """
+    def __init__(self, store, on_done, workers = 4, max_queue = 1000, timeout = 10,
+                 max_bytes = 10 * 1024 * 1024, retries = 2, backoff = 0.5):
+        self.store = store
+        self.on_done = on_done
+        self.workers = workers
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = Queue.Queue(max_queue)
+        self.pool = ConnectionPool(timeout, max_per_host = workers)
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start worker threads if they are not running"""
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target = self._work, name = 'image-ingest-%d' % i)
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+
+    def after_fork(self):
+        """Forget the threads, queue and connections of the parent process"""
+        self.queue = Queue.Queue(self.queue.maxsize)
+        self.pool = ConnectionPool(self.timeout, max_per_host = self.workers)
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, image_id, url, block = False):
+        """Queue a download
+
+        Args:
+            block: wait for a free place if the queue is full, used by bulk
+                imports to keep pace with the downloads
+        Returns:
+            False if the queue is full
+        """
+        self.start()
+        try:
+            self.queue.put((image_id, url), block)
+            return True
+        except Queue.Full:
+            logging.warning('image ingest queue full, dropped image %s', image_id)
+            return False
+
+    def wait(self):
+        """Block until all queued downloads are done"""
+        self.queue.join()
+
+    @property
+    def depth(self):
+        """Number of waiting downloads"""
+        return self.queue.qsize()
+
+    def _work(self):
+        while True:
+            image_id, url = self.queue.get()
+            try:
+                self._ingest(image_id, url)
+            except Exception:
+                logging.exception('image ingest callback failed for image %s', image_id)
+            finally:
+                self.queue.task_done()
+
+    def _ingest(self, image_id, url):
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                stored = self.download(url)
+            except IngestError as e:
+                error = str(e)
+                break
+            except (httplib.HTTPException, socket.error, EnvironmentError) as e:
+                error = '%s: %s' % (type(e).__name__, e)
+            except Exception as e:
+                # a bug or a file the store can't read, the image must still
+                # leave the pending state
+                logging.exception('image %s ingest from %s failed', image_id, url)
+                error = '%s: %s' % (type(e).__name__, e)
+                break
+            else:
+                self.on_done(image_id, stored, None)
+                return
+        logging.warning('image %s download from %s failed: %s', image_id, url, error)
+        self.on_done(image_id, None, error)
+
+    def download(self, url):
+        """Download url into the store
+
+        The file is written under a temporary name and hashed while it is
+        downloaded, then moved into the store under its content hash.
+
+        Returns:
+            StoredImage
+        """
+        # unique among the threads and processes writing the store
+        fd, tmp_path = tempfile.mkstemp(prefix = '.', suffix = '.part', dir = self.store.folder)
+        try:
+            digest = new_hash()
+            with os.fdopen(fd, 'wb') as f:
+                content_type = self.fetch(url, f, digest)
+            os.chmod(tmp_path, 0o644) # mkstemp makes it private
+            return self.store.put(tmp_path, digest.hexdigest(), guess_ext(content_type, url))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def fetch(self, url, f, digest):
+        """Write the body of url into file f, following redirects
+
+        Args:
+            digest: hash object updated with the body
+        Returns:
+            content type of the response
+        """
+        for i in range(MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ('http', 'https') or not parts.netloc:
+                raise IngestError('unsupported url %r' % url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+
+            conn = self.pool.get(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path, headers = {'User-Agent': USER_AGENT})
+                resp = conn.getresponse()
+                if resp.status in (301, 302, 303, 307, 308) and resp.getheader('location'):
+                    resp.read()
+                    url = urlparse.urljoin(url, resp.getheader('location'))
+                elif resp.status != 200:
+                    resp.read()
+                    if resp.status < 500:
+                        raise IngestError('HTTP %d' % resp.status)
+                    raise IOError('HTTP %d' % resp.status)
+                else:
+                    self._read_body(resp, f, digest)
+            except:
+                conn.close()
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self.pool.put(parts.scheme, parts.netloc, conn)
+            if resp.status == 200:
+                return resp.getheader('content-type')
+        raise IngestError('too many redirects')
+
+    def _read_body(self, resp, f, digest):
+        length = resp.getheader('content-length')
+        if length and length.isdigit() and int(length) > self.max_bytes:
+            raise IngestError('image larger than %d bytes' % self.max_bytes)
+        size = 0
+        while True:
+            buffer = resp.read(BLOCK_SIZE)
+            if not buffer:
+                break
+            size += len(buffer)
+            if size > self.max_bytes:
+                raise IngestError('image larger than %d bytes' % self.max_bytes)
+            f.write(buffer)
+            digest.update(buffer)
@@ -0,0 +1,79 @@
+"""
+Stored images served under IMAGE_URL_PREFIX, e.g. /images/3f/3fa2...c1.jpg
+
+Stored files are named by the sha256 of their content, so a url never
+changes its content. These fingerprinted urls get a strong ETag made of the
+digest and an immutable Cache-Control of IMAGE_MAX_AGE seconds. Other files
+of the folder are revalidated by their ETag on every request.
+
+By default the file is sent by the app through the server's wsgi.file_wrapper,
+i.e. sendfile under gunicorn, and Range requests are answered with 206
+Partial Content. With IMAGE_SENDFILE_HEADER set, the app only checks the
+request and sets the headers, the front server sends the file:
+
+    X-Accel-Redirect: nginx, with an internal location at IMAGE_ACCEL_PREFIX
+        location /protected-images/ {
+            internal;
+            alias /path/to/Catalog/static/images/;
+        }
+    X-Sendfile: Apache mod_xsendfile or lighttpd
+"""
+
+import mimetypes
+import os
+import re
+
+from flask import Response, abort, request, send_file, safe_join
+from werkzeug.exceptions import NotFound
+
+import config
+from catalogDB import image_store
+
+# "<sha256>.<ext>" or "<sha256>_<derivative>.<ext>"
+FINGERPRINTED = re.compile(r'^([0-9a-f]{64}(?:_[a-z]+)?)\.\w+$')
+
+def file_etag(filename, path):
+    """(etag, is fingerprinted) of a file of the store"""
+    match = FINGERPRINTED.match(os.path.basename(filename))
+    if match:
+        return match.group(1), True
+    stat = os.stat(path)
+    return '%x-%x' % (int(stat.st_mtime), stat.st_size), False
+
+def send_image(filename):
+    """View of IMAGE_URL_PREFIX<filename>"""
+    try:
+        path = safe_join(image_store.folder, filename)
+    except NotFound:
+        abort(404)
+    if not os.path.isfile(path):
+        abort(404)
+    etag, fingerprinted = file_etag(filename, path)
+
+    sendfile_header = config.IMAGE_SENDFILE_HEADER
+    if sendfile_header:
+        # the front server answers ranges and sends the body
+        response = Response(mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        if sendfile_header.lower() == 'x-accel-redirect':
+            response.headers['X-Accel-Redirect'] = config.IMAGE_ACCEL_PREFIX + filename
+        else:
+            response.headers[sendfile_header] = os.path.abspath(path)
+    else:
+        response = send_file(os.path.abspath(path), add_etags = False, conditional = False)
+
+    response.set_etag(etag)
+    response.headers.pop('Expires', None) # Cache-Control is enough
+    if fingerprinted:
+        response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % config.IMAGE_MAX_AGE
+    else:
+        response.headers['Cache-Control'] = 'public, no-cache'
+    if sendfile_header:
+        return response.make_conditional(request)
+    return response.make_conditional(request, accept_ranges = True,
+                                     complete_length = os.path.getsize(path))
+
+def init_app(app):
+    """Serve the image store under IMAGE_URL_PREFIX"""
+    if not config.IMAGE_URL_PREFIX:
+        return
+    app.add_url_rule(config.IMAGE_URL_PREFIX + '<path:filename>', 'image_file', send_image)
@@ -0,0 +1,163 @@
+"""
+Content-addressed image files.
+
+Files are named by the sha256 of their content, like
+"static/images/3f/3fa2...c1.jpg", so the same image downloaded for many items
+is stored once and two different images never overwrite each other.
+Resized derivatives are generated once, when a file is first stored, if PIL
+is installed.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+# derivative name -> max (width, height)
+DERIVATIVES = {
+    'thumb': (300, 300),
+    'medium': (800, 800),
+}
+JPEG_QUALITY = 85
+RESAMPLE = PILImage and getattr(PILImage, 'LANCZOS', None) or getattr(PILImage, 'ANTIALIAS', None)
+
+CONTENT_TYPE_EXTS = {
+    'image/jpeg': '.jpg',
+    'image/pjpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+    'image/svg+xml': '.svg',
+}
+DEFAULT_EXT = '.jpg'
+
+def guess_ext(content_type, url):
+    """File extension from the response content type, then from the url"""
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in CONTENT_TYPE_EXTS:
+        return CONTENT_TYPE_EXTS[content_type]
+    ext = os.path.splitext(url.split('?')[0])[1].lower()
+    if ext in CONTENT_TYPE_EXTS.values() or ext == '.jpeg':
+        return ext
+    return DEFAULT_EXT
+
+def new_hash():
+    """Hash object to feed with file content while it is downloaded"""
+    return hashlib.sha256()
+
+class StoredImage(object):
+    """Paths of a stored file and its derivatives
+
+    Attributes:
+        digest: hex sha256 of the content
+        src: html src of the original, like "/static/images/3f/3fa2...c1.jpg"
+        thumb_src, medium_src: html src of derivatives, None if not generated
+    """
+    def __init__(self, digest, src, thumb_src = None, medium_src = None):
+        self.digest = digest
+        self.src = src
+        self.thumb_src = thumb_src
+        self.medium_src = medium_src
+
+class ImageStore(object):
+    """Folder of content-addressed images
+
+    Attributes:
+        folder: relative folder path like "static/images/", also used to
+            build html src
+        url_prefix: url the files are served under instead of "/<folder>",
+            like "/images/", empty to keep "/<folder>"
+    """
+    def __init__(self, folder, url_prefix = ''):
+        self.folder = folder
+        self.url_prefix = url_prefix
+
+    def url(self, src):
+        """Served url of an html src returned by put, other srcs are returned as is"""
+        prefix = '/' + self.folder
+        if self.url_prefix and src and src.startswith(prefix):
+            return self.url_prefix + src[len(prefix):]
+        return src
+
+    def path(self, digest, suffix):
+        """Relative path of a file, e.g. path(digest, '.jpg')"""
+        return os.path.join(self.folder, digest[:2], digest + suffix)
+
+    def put(self, tmp_path, digest, ext):
+        """Move a downloaded file into the store
+
+        If a file with the same content is already stored, tmp_path is removed
+        and the existing file is used. Derivatives are generated if missing.
+
+        Args:
+            tmp_path: downloaded file
+            digest: hex sha256 of its content
+            ext: file extension like '.jpg'
+        Returns:
+            StoredImage
+        """
+        file_path = self.path(digest, ext)
+        if os.path.exists(file_path):
+            os.remove(tmp_path)
+        else:
+            folder = os.path.dirname(file_path)
+            if not os.path.isdir(folder):
+                try:
+                    os.makedirs(folder)
+                except OSError:
+                    # created by another worker meanwhile
+                    if not os.path.isdir(folder):
+                        raise
+            os.rename(tmp_path, file_path)
+
+        stored = StoredImage(digest, '/' + file_path)
+        for name, size in DERIVATIVES.items():
+            setattr(stored, name + '_src', self.derive(file_path, digest, name, size))
+        return stored
+
+    def derive(self, file_path, digest, name, size):
+        """Generate a resized JPEG copy of file_path unless it exists
+
+        Returns:
+            html src of the copy, None if it can't be generated
+        """
+        if PILImage is None:
+            return None
+        derived_path = self.path(digest, '_%s.jpg' % name)
+        if not os.path.exists(derived_path):
+            tmp_path = None
+            try:
+                img = PILImage.open(file_path)
+                img.thumbnail(size, RESAMPLE)
+                if img.mode != 'RGB':
+                    img = img.convert('RGB')
+                # unique among the threads and processes writing the store
+                fd, tmp_path = tempfile.mkstemp(suffix = '.part', dir = os.path.dirname(derived_path))
+                with os.fdopen(fd, 'wb') as f:
+                    img.save(f, 'JPEG', quality = JPEG_QUALITY, optimize = True)
+                os.chmod(tmp_path, 0o644) # mkstemp makes it private
+                os.rename(tmp_path, derived_path)
+            except (EnvironmentError, ValueError) as e:
+                logging.warning('can not make %s of %s: %s', name, file_path, e)
+                if tmp_path and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                return None
+        return '/' + derived_path
+
+    def remove(self, src):
+        """Remove a stored file and its derivatives
+
+        Args:
+            src: html src of the original returned by put
+        """
+        file_path = src.lstrip('/')
+        digest = os.path.splitext(os.path.basename(file_path))[0]
+        for path in [file_path] + \
+                    [self.path(digest, '_%s.jpg' % name) for name in DERIVATIVES]:
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,40 @@
+"""
+Fast JSON for the API endpoints and catalog imports.
+
+Payloads are built from plain dicts and tuples, so the encoder never has to
+call back into Python for unknown types. The fastest available encoder is
+used: ujson, then simplejson, then the standard json module.
+"""
+
+from flask import Response
+from werkzeug.http import http_date
+
+try:
+    import ujson as _json
+    def _dumps(obj):
+        return _json.dumps(obj, ensure_ascii=False)
+except ImportError:
+    try:
+        import simplejson as _json
+    except ImportError:
+        import json as _json
+    def _dumps(obj):
+        return _json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+def format_datetime(dt):
+    """Format datetime the same way as flask.jsonify, e.g. 
+    "Sun, 18 Oct 2015 09:46:35 GMT"
+    """
+    return dt and http_date(dt)
+
+def dumps(obj):
+    """Encode obj as compact JSON text"""
+    return _dumps(obj)
+
+def loads(text):
+    """Decode JSON text"""
+    return _json.loads(text)
+
+def json_response(obj):
+    """Flask response of obj encoded as JSON"""
+    return Response(dumps(obj), mimetype='application/json')
@@ -10,15 +10,11 @@ import random
 import string
 import logging
 
-from sqlalchemy import Column, ForeignKey, Integer, String, Text
-from sqlalchemy.ext.declarative import declarative_base
+from catalogDB import User
+from fragmentCache import LRUBackend
+import config
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-
-Base = declarative_base()
-
-from flask import flash, make_response, render_template, request, redirect, jsonify, url_for
+from flask import flash, make_response, render_template, request, redirect, jsonify, url_for, g
 from functools import wraps
 
 SECRET = 'AK1747' # secret word used for hashing string
@@ -91,6 +87,13 @@ def redirect_url():
     return request.args.get('next') or request.referrer or \
            url_for('renderHomePage')
 
+class UserRecord(object):
+    """Plain copy of a user row, safe to share between requests and threads"""
+    def __init__(self, user):
+        self.id = user.id
+        self.name = user.name
+        self.email = user.email
+
 class LoginManager:
     """Accounts System
     
@@ -99,14 +102,22 @@ class LoginManager:
 
     After logging in, the page will redirect to previous page. 
 
+    The user of each request is resolved by load_user, registered as
+    before_request hook, and kept in flask.g. User records are cached for
+    config.USER_CACHE_TTL seconds, so most requests don't query 'user' table.
+
     Attributes:
         path: The app's base url. Like "/catalog" 
-        user: After successfully one logs in, it will create a user object
-            retrieved from 'user' table. 
+        user: UserRecord of the logged in user of the current request, or None
+        user_cache: uid -> UserRecord, False if no such user
     """ 
     def __init__(self, path):
         self.path = path
-        self.user = None
+        self.user_cache = LRUBackend(config.USER_CACHE_SIZE)
+
+    @property
+    def user(self):
+        return getattr(g, 'user', None)
 
     USER_RE = re.compile(r"^[a-zA-Z0-9_-]{3,20}$")
     def valid_username(self, username):
@@ -148,10 +159,24 @@ class LoginManager:
         """
         response.set_cookie('user_id', value=set_cookie_val(user.id), path='/catalog')
 
-    def initialize(self):
-        """Read cookie and retrieve user object"""
+    def get_user_record(self, uid):
+        """Get UserRecord by id through user_cache"""
+        record = self.user_cache.get(uid)
+        if record is None:
+            u = User.get_by_id(uid)
+            record = u and UserRecord(u) or False
+            self.user_cache.set(uid, record, config.USER_CACHE_TTL)
+        return record or None
+
+    def load_user(self):
+        """Verify the signed cookie and set the user of this request"""
         uid = self.read_cookie('user_id')
-        self.user = uid and User.get_by_id(int(uid))
+        g.user = uid and uid.isdigit() and self.get_user_record(int(uid)) or None
+
+    def initialize(self):
+        """Read cookie and retrieve user object if load_user hasn't"""
+        if not hasattr(g, 'user'):
+            self.load_user()
         
     def get_valid_user(self, name, pw):
         """Check if name and pw are paired
@@ -166,10 +191,10 @@ class LoginManager:
         """decorator to decorate functions which require login"""
         @wraps(func)
         def login_checker(*a, **kw):
-            ret = func(*a, **kw)
+            self.initialize()
             if not self.user:
                 return redirect(url_for('login'))
-            return ret
+            return func(*a, **kw)
         return login_checker
 
     def login(self, *a, **kw):
@@ -178,7 +203,7 @@ class LoginManager:
         If the request method is 'POST',
         1. Verify user.
         2. Render error message if the user doesn't exist or wrong password.
-        3. Set cookie, set self.user and return response to redirect to previous 
+        3. Set cookie, set user and return response to redirect to previous 
         page if valid user
 
         If the request method is 'GET',
@@ -203,7 +228,7 @@ class LoginManager:
                 redirect_to_prev = redirect(request.form['next_url'])
                 response = make_response(redirect_to_prev)
                 self.login_set_cookie(u, response)
-                self.user = u
+                g.user = UserRecord(u)
                 return response
         else:
             # remember the previous url using redirect_url()
@@ -219,7 +244,7 @@ class LoginManager:
         1. Verify username, password, password_verify and email.
         2. Create user if all above are correct.
         3. Render error messages if some of them are incorrect.
-        4. Set cookie, set self.user, and redirect to home
+        4. Set cookie, set user, and redirect to home
 
         If the request method is 'GET',
         Render the signup page
@@ -260,11 +285,11 @@ class LoginManager:
             if has_fault:
                 return render_template("signup.html", **params)
             else:
-                u = User.store(username, password, email)
+                u = User.store(username, make_password(username, password), email)
                 redirect_to_home = redirect(url_for('renderHomePage'))
                 response = make_response(redirect_to_home)
                 self.login_set_cookie(u, response)
-                self.user = u
+                g.user = UserRecord(u)
                 return response
         else:
             return render_template('signup.html')
@@ -273,7 +298,7 @@ class LoginManager:
     def logout(self):
         """Logout
 
-        Redirect to home, set the cookie null and set self.user None
+        Redirect to home, set the cookie null and set user None
 
         Return:
             flask response
@@ -281,44 +306,5 @@ class LoginManager:
         redirect_to_home = redirect(url_for('renderHomePage'))
         response = make_response(redirect_to_home)
         response.set_cookie('user_id', value='', path='/catalog')
-        self.user = None
+        g.user = None
         return response
-
-# User
-class User(Base):
-    """User table
-        
-    Columns: Id, Name, Hashed Password, Email Address
-
-    Methods which interact Category table are classmethods.
-    Methods which interact row are instance methods.
-    """
-    __tablename__ = 'user'
-
-    id = Column(Integer, primary_key=True)
-    name = Column(String(250), nullable=False)
-    pw_hash = Column(String(250), nullable=False)
-    email = Column(String(250))
-
-    @classmethod
-    def get_by_name(cls, name):
-        return session.query(User).filter_by(name = name).first()
-
-    @classmethod
-    def get_by_id(cls, uid):
-        return session.query(User).filter_by(id = uid).first()
-
-    @classmethod
-    def store(cls, name, pw, email):
-        """return newly stored user object"""
-        newUser = User(name=name, pw_hash=make_password(name, pw), email=email)
-        session.add(newUser)
-        session.commit()
-        return newUser
-        
-
-engine = create_engine('postgresql+psycopg2:///catalog')
-Base.metadata.create_all(engine)
-
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
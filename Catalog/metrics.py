@@ -0,0 +1,390 @@
+"""
+Prometheus metrics of the app, served at /metrics.
+
+Requests are counted and timed per endpoint. Every thread records into its
+own shard, so recording takes no lock. A scrape sums the shards, and adds
+the database pool stats, the image download queue depth and the fragment
+cache hits sampled at that moment.
+
+When several worker processes serve the app, set METRICS_DIR to a folder
+shared by them and emptied at startup. Each process then records into a
+memory mapped file, "<METRICS_DIR>/<pid>-<start time>.db", updated in place
+on every update, and a scrape of any process sums all files. The sampled
+values are written at the end of every request. Counters of exited
+processes are kept so totals never go down, gauges only count the running
+processes. The start time in the name tells a new process from an exited
+one with the same pid.
+"""
+
+import bisect
+import errno
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from flask import Response, g, request
+
+import config
+from database import pool_stats
+from catalogDB import image_ingestor
+from fragmentCache import fragment_cache
+
+# seconds, upper bounds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help)
+METRICS = {
+    'catalog_requests_total': ('counter', 'Requests by endpoint, method and status'),
+    'catalog_request_duration_seconds': ('histogram', 'Request latency by endpoint, streaming included'),
+    'catalog_requests_in_progress': ('gauge', 'Requests being served by endpoint'),
+    'catalog_db_queries_total': ('counter', 'SQL statements by endpoint'),
+    'catalog_db_pool_size': ('gauge', 'Connections kept open by the pools'),
+    'catalog_db_pool_checked_out': ('gauge', 'Connections in use'),
+    'catalog_db_pool_overflow': ('gauge', 'Connections open beyond the pool size'),
+    'catalog_db_pool_checkouts_total': ('counter', 'Connection checkouts'),
+    'catalog_db_pool_wait_seconds_total': ('counter', 'Time spent waiting for a connection'),
+    'catalog_db_pool_wait_max_seconds': ('gauge', 'Longest wait for a connection'),
+    'catalog_image_ingest_queue_depth': ('gauge', 'Image downloads waiting'),
+    'catalog_fragment_cache_hits_total': ('counter', 'Fragment cache hits'),
+    'catalog_fragment_cache_misses_total': ('counter', 'Fragment cache misses'),
+    'catalog_fragment_cache_hit_ratio': ('gauge', 'Fragment cache hits / lookups'),
+}
+MAX_GAUGES = set(['catalog_db_pool_wait_max_seconds']) # aggregated by max, not sum
+
+class Shard(object):
+    """Metrics recorded by one thread
+
+    Keys are (name, labels), labels being a tuple of (name, value) pairs.
+    Histogram values are a count per bucket, then +Inf, then the sum.
+    """
+    def __init__(self):
+        self.thread = threading.current_thread()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+class ValueFile(object):
+    """Values of this process in a memory mapped file, read by the others
+
+    The file starts with the number of bytes used. Each entry is the length
+    of its JSON key, the key padded to 8 bytes, then a double. Values are
+    updated in place, with no system call. A new entry is written before the
+    used size, so a reader never sees a partial one.
+
+    Keys are (kind, name, labels, index), index being the bucket of a
+    histogram and None for other kinds.
+    """
+    def __init__(self, path, size = 64 * 1024):
+        self.path = path
+        self.lock = threading.Lock()
+        self.positions = {} # key -> offset of its value
+        self.file = open(path, 'w+b')
+        self.size = size
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.used = 8
+        struct.pack_into('<I', self.map, 0, self.used)
+
+    def add(self, key, value):
+        with self.lock:
+            pos = self.positions.get(key) or self.new_entry(key)
+            struct.pack_into('<d', self.map, pos, struct.unpack_from('<d', self.map, pos)[0] + value)
+
+    def set(self, key, value):
+        with self.lock:
+            pos = self.positions.get(key) or self.new_entry(key)
+            struct.pack_into('<d', self.map, pos, value)
+
+    def new_entry(self, key):
+        kind, name, labels, index = key
+        encoded = json.dumps([kind, name, labels, index]).encode('utf-8')
+        encoded += b' ' * (-(4 + len(encoded)) % 8)
+        entry_size = 4 + len(encoded) + 8
+        while self.used + entry_size > self.size:
+            self.map.close()
+            self.size *= 2
+            self.file.truncate(self.size)
+            self.map = mmap.mmap(self.file.fileno(), self.size)
+        struct.pack_into('<I%dsd' % len(encoded), self.map, self.used, len(encoded), encoded, 0.0)
+        pos = self.used + 4 + len(encoded)
+        self.used += entry_size
+        struct.pack_into('<I', self.map, 0, self.used)
+        self.positions[key] = pos
+        return pos
+
+def read_values(path):
+    """(key, value) of the entries of a ValueFile"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    used = struct.unpack_from('<I', data, 0)[0]
+    pos = 8
+    while pos < used:
+        length = struct.unpack_from('<I', data, pos)[0]
+        kind, name, labels, index = json.loads(data[pos + 4:pos + 4 + length].decode('utf-8'))
+        value = struct.unpack_from('<d', data, pos + 4 + length)[0]
+        pos += 4 + length + 8
+        labels = tuple(tuple(l) for l in labels)
+        yield (kind, name, labels, index), int(value) if value == int(value) else value
+
+class Registry(object):
+    """Metrics of this process
+
+    Recorded into thread shards, or with METRICS_DIR set, into the ValueFile
+    of the process.
+    """
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.local = threading.local()
+        self.lock = threading.Lock() # only taken for a new thread and to collect
+        self.shards = []
+        self.retired = Shard() # merged shards of finished threads
+        self.file = None
+        self.file_pid = None
+
+    def value_file(self):
+        """ValueFile of this process, None if METRICS_DIR isn't set
+
+        A forked process creates its own.
+        """
+        if not config.METRICS_DIR:
+            return None
+        if self.file_pid != os.getpid():
+            with self.lock:
+                if self.file_pid != os.getpid():
+                    self.file = ValueFile(value_path(os.getpid(), process_start(os.getpid())))
+                    self.file_pid = os.getpid()
+        return self.file
+
+    def shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = Shard()
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    def inc(self, name, labels = (), value = 1):
+        values = self.value_file()
+        if values:
+            return values.add(('counters', name, labels, None), value)
+        counters = self.shard().counters
+        counters[(name, labels)] = counters.get((name, labels), 0) + value
+
+    def add_gauge(self, name, labels = (), value = 1):
+        values = self.value_file()
+        if values:
+            return values.add(('gauges', name, labels, None), value)
+        gauges = self.shard().gauges
+        gauges[(name, labels)] = gauges.get((name, labels), 0) + value
+
+    def observe(self, name, labels, value):
+        values = self.value_file()
+        if values:
+            values.add(('histograms', name, labels, bisect.bisect_left(self.buckets, value)), 1)
+            values.add(('histograms', name, labels, len(self.buckets) + 1), value)
+            return
+        histograms = self.shard().histograms
+        counts = histograms.get((name, labels))
+        if counts is None:
+            counts = histograms[(name, labels)] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def collect(self):
+        """Sum of the shards as a snapshot dict"""
+        snapshot = dict(counters = {}, gauges = {}, histograms = {})
+        with self.lock:
+            live = []
+            for shard in self.shards:
+                if shard.thread.is_alive():
+                    live.append(shard)
+                else:
+                    merge_shard(self.retired, shard)
+            self.shards = live
+            for shard in [self.retired] + live:
+                merge_shard(snapshot, shard)
+        return snapshot
+
+def merge_shard(into, shard):
+    """Add the values of a Shard into a Shard or snapshot dict"""
+    get = (lambda kind: into[kind]) if isinstance(into, dict) else (lambda kind: getattr(into, kind))
+    for kind in ('counters', 'gauges'):
+        target = get(kind)
+        for key, value in list(getattr(shard, kind).items()):
+            target[key] = target.get(key, 0) + value
+    target = get('histograms')
+    for key, counts in list(shard.histograms.items()):
+        total = target.get(key)
+        if total is None:
+            target[key] = list(counts)
+        else:
+            target[key] = [a + b for a, b in zip(total, counts)]
+
+def sample_app_stats(snapshot):
+    """Add the pool, image queue and cache values of this process"""
+    counters = snapshot['counters']
+    gauges = snapshot['gauges']
+    stats = pool_stats()
+    gauges[('catalog_db_pool_size', ())] = stats['size']
+    gauges[('catalog_db_pool_checked_out', ())] = stats['checked_out']
+    gauges[('catalog_db_pool_overflow', ())] = stats['overflow']
+    gauges[('catalog_db_pool_wait_max_seconds', ())] = stats['wait_max']
+    counters[('catalog_db_pool_checkouts_total', ())] = stats['checkouts']
+    counters[('catalog_db_pool_wait_seconds_total', ())] = stats['wait_total']
+    gauges[('catalog_image_ingest_queue_depth', ())] = image_ingestor.depth
+    counters[('catalog_fragment_cache_hits_total', ())] = fragment_cache.hits
+    counters[('catalog_fragment_cache_misses_total', ())] = fragment_cache.misses
+    return snapshot
+
+registry = Registry()
+
+# Multi-process files
+
+VALUE_FILE_SUFFIX = '.db'
+
+def value_path(pid, start):
+    return os.path.join(config.METRICS_DIR, '%d-%s%s' % (pid, start, VALUE_FILE_SUFFIX))
+
+def process_start(pid):
+    """Start time of a process, in clock ticks since boot, '' if unknown
+
+    Read from /proc on Linux. Elsewhere processes are only told apart by pid.
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            return f.read().rsplit(')', 1)[1].split()[19]
+    except (EnvironmentError, IndexError):
+        return ''
+
+def is_running(pid, start = ''):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno != errno.EPERM:
+            return False
+    return process_start(pid) == start
+
+def flush():
+    """Write the sampled values of this process into its ValueFile"""
+    values = registry.value_file()
+    snapshot = sample_app_stats(dict(counters = {}, gauges = {}, histograms = {}))
+    for kind in ('counters', 'gauges'):
+        for (name, labels), value in snapshot[kind].items():
+            values.set((kind, name, labels, None), value)
+
+def aggregate():
+    """Snapshot of this process, plus the ValueFiles of the other ones"""
+    if not config.METRICS_DIR:
+        return sample_app_stats(registry.collect())
+    flush()
+    total = dict(counters = {}, gauges = {}, histograms = {})
+    for path in glob.glob(os.path.join(config.METRICS_DIR, '*' + VALUE_FILE_SUFFIX)):
+        pid, start = os.path.basename(path)[:-len(VALUE_FILE_SUFFIX)].split('-', 1)
+        try:
+            values = list(read_values(path))
+        except (EnvironmentError, ValueError, struct.error):
+            continue
+        running = is_running(int(pid), start)
+        for (kind, name, labels, index), value in values:
+            key = (name, labels)
+            if kind == 'counters':
+                total['counters'][key] = total['counters'].get(key, 0) + value
+            elif kind == 'histograms':
+                counts = total['histograms'].get(key)
+                if counts is None:
+                    counts = total['histograms'][key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+                counts[index] += value
+            elif running and name in MAX_GAUGES:
+                total['gauges'][key] = max(total['gauges'].get(key, 0), value)
+            elif running:
+                total['gauges'][key] = total['gauges'].get(key, 0) + value
+    return total
+
+# Exposition
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escape = lambda v: ('%s' % v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{%s}' % ','.join('%s="%s"' % (k, escape(v)) for k, v in labels)
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return '%d' % value
+
+def exposition(snapshot, buckets = LATENCY_BUCKETS):
+    """Prometheus text format of a snapshot"""
+    hits = snapshot['counters'].get(('catalog_fragment_cache_hits_total', ()), 0)
+    misses = snapshot['counters'].get(('catalog_fragment_cache_misses_total', ()), 0)
+    if hits + misses:
+        snapshot['gauges'][('catalog_fragment_cache_hit_ratio', ())] = float(hits) / (hits + misses)
+
+    series = {} # name -> list of (labels, value) of all kinds
+    for kind in ('counters', 'gauges', 'histograms'):
+        for (name, labels), value in snapshot[kind].items():
+            series.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name in sorted(series):
+        kind, help = METRICS.get(name, ('untyped', name))
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in sorted(series[name]):
+            if kind != 'histogram':
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+                continue
+            cumulative = 0
+            for le, count in zip([repr(b) for b in buckets] + ['+Inf'], value[:-1]):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', le),)), cumulative))
+            lines.append('%s_sum%s %s' % (name, format_labels(labels), repr(value[-1])))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), cumulative))
+    return '\n'.join(lines) + '\n'
+
+# Request hooks
+
+def start_request():
+    """before_request: count the request as in progress"""
+    g.metrics_start = time.time()
+    g.metrics_endpoint = request.endpoint or 'none'
+    registry.add_gauge('catalog_requests_in_progress', (('endpoint', g.metrics_endpoint),))
+
+def record_status(response):
+    """after_request"""
+    g.metrics_status = response.status_code
+    return response
+
+def finish_request(exception = None):
+    """teardown_request: record the request once its response is sent"""
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return
+    endpoint = (('endpoint', g.metrics_endpoint),)
+    registry.add_gauge('catalog_requests_in_progress', endpoint, -1)
+    registry.observe('catalog_request_duration_seconds', endpoint, time.time() - start)
+    status = exception is None and g.get('metrics_status', 500) or 500
+    registry.inc('catalog_requests_total', endpoint + (('method', request.method), ('status', status)))
+    query_stats = g.get('query_stats')
+    if query_stats is not None:
+        registry.inc('catalog_db_queries_total', endpoint, query_stats.count)
+    if config.METRICS_DIR:
+        flush()
+
+def metrics_view():
+    return Response(exposition(aggregate()), mimetype = 'text/plain; version=0.0.4')
+
+def init_app(app):
+    """Record the requests of app and serve /metrics"""
+    if not config.METRICS_ENABLED:
+        return
+    if config.METRICS_DIR and not os.path.isdir(config.METRICS_DIR):
+        os.makedirs(config.METRICS_DIR)
+    app.before_request(start_request)
+    app.after_request(record_status)
+    app.teardown_request(finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
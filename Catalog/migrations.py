@@ -0,0 +1,165 @@
+"""
+Versioned schema migrations.
+
+    python Catalog/migrations.py [upgrade | current]
+
+The version of a database is the highest version recorded in its
+schema_version table. upgrade runs the migrations above it in order, each in
+its own transaction together with its schema_version row.
+
+Migrations only add what is missing, so they can be run on a database created
+from the current models by create_all as well as on one created by an older
+version of the app.
+"""
+
+import datetime
+import logging
+import sys
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table
+from sqlalchemy import and_, func, inspect, select
+from sqlalchemy.schema import CreateColumn
+
+from catalogDB import Base, Item, Image
+from database import get_engine
+
+schema_version = Table('schema_version', MetaData(),
+                       Column('version', Integer, primary_key=True),
+                       Column('description', String(250)),
+                       Column('applied', DateTime))
+
+MIGRATIONS = [] # (version, description, function taking a connection)
+
+class MigrationError(Exception):
+    """A migration can't be applied to the data as it is"""
+    pass
+
+def migration(version, description):
+    """Decorator registering a migration"""
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return register
+
+# Operations
+
+def add_column(conn, column):
+    """Add a column of a model table unless it exists"""
+    table = column.table.name
+    if column.name in [c['name'] for c in inspect(conn).get_columns(table)]:
+        return
+    conn.execute('ALTER TABLE %s ADD COLUMN %s' % (
+        conn.dialect.identifier_preparer.quote(table),
+        CreateColumn(column).compile(dialect = conn.dialect)))
+
+def check_unique(conn, index):
+    """Raise MigrationError if the columns of a unique index have duplicates"""
+    cols = list(index.columns)
+    duplicates = conn.execute(select(cols).where(and_(*[c != None for c in cols]))
+                                          .group_by(*cols)
+                                          .having(func.count() > 1)
+                                          .limit(5)).fetchall()
+    if duplicates:
+        raise MigrationError('%s can not be created, %s has duplicates like %s' % (
+            index.name, ', '.join(c.name for c in cols), ', '.join(repr(tuple(d)) for d in duplicates)))
+
+def create_index(conn, index):
+    """Create an index of a model table unless it exists"""
+    existing = [i['name'] for i in inspect(conn).get_indexes(index.table.name)]
+    if index.name in existing:
+        return
+    if index.unique:
+        check_unique(conn, index)
+    index.create(conn)
+
+def model_index(name):
+    for table in Base.metadata.tables.values():
+        for index in table.indexes:
+            if index.name == name:
+                return index
+    raise KeyError(name)
+
+# Migrations
+
+@migration(1, 'create tables')
+def create_tables(conn):
+    Base.metadata.create_all(conn)
+
+@migration(2, 'image download status and stored files')
+def add_image_status(conn):
+    for column in ('img_hash', 'thumb_src', 'medium_src', 'status'):
+        add_column(conn, Image.__table__.c[column])
+
+@migration(3, 'item.img_id references image.id')
+def add_image_foreign_key(conn):
+    # SQLite can't add a constraint to an existing table, the model declares
+    # it for new databases
+    if conn.dialect.name != 'postgresql':
+        return
+    names = [fk['name'] for fk in inspect(conn).get_foreign_keys('item')
+             if fk['referred_table'] == 'image']
+    if names:
+        return
+    conn.execute('UPDATE item SET img_id = NULL WHERE img_id IS NOT NULL '
+                 'AND NOT EXISTS (SELECT 1 FROM image WHERE image.id = item.img_id)')
+    conn.execute('ALTER TABLE item ADD CONSTRAINT item_img_id_fkey '
+                 'FOREIGN KEY (img_id) REFERENCES image (id)')
+
+@migration(4, 'ids of imported items')
+def add_ext_ids(conn):
+    add_column(conn, Item.__table__.c.ext_id)
+    add_column(conn, Image.__table__.c.ext_id)
+    create_index(conn, model_index('ix_item_ext_id'))
+    create_index(conn, model_index('ix_image_ext_id'))
+
+@migration(5, 'indexes of lookup and ordering columns')
+def add_lookup_indexes(conn):
+    for name in ('ix_category_name', 'ix_category_datetime',
+                 'ix_item_title', 'ix_item_img_id', 'ix_item_datetime', 'ix_item_category_datetime',
+                 'ix_image_img_hash', 'ix_image_status', 'ix_image_datetime',
+                 'ix_user_name'):
+        create_index(conn, model_index(name))
+
+# Runner
+
+def current_version(conn):
+    """Version of the database, 0 if no migration was applied"""
+    if not conn.dialect.has_table(conn, 'schema_version'):
+        return 0
+    return conn.execute(select([func.max(schema_version.c.version)])).scalar() or 0
+
+def upgrade(bind = None):
+    """Apply the migrations the database doesn't have
+
+    Returns:
+        list of applied versions
+    """
+    bind = bind or get_engine()
+    schema_version.create(bind, checkfirst = True)
+    applied = []
+    for version, description, migrate in sorted(MIGRATIONS):
+        with bind.begin() as conn:
+            if current_version(conn) >= version:
+                continue
+            logging.info('migration %d: %s', version, description)
+            migrate(conn)
+            conn.execute(schema_version.insert(), version = version,
+                         description = description, applied = datetime.datetime.now())
+        applied.append(version)
+    return applied
+
+def main(argv = None):
+    argv = sys.argv[1:] if argv is None else argv
+    command = argv and argv[0] or 'upgrade'
+    logging.basicConfig(level = logging.INFO, format = '%(message)s')
+    if command == 'upgrade':
+        applied = upgrade()
+        logging.info(applied and 'upgraded to version %d' % applied[-1] or 'already up to date')
+    elif command == 'current':
+        with get_engine().connect() as conn:
+            print(current_version(conn))
+    else:
+        sys.exit('usage: migrations.py [upgrade | current]')
+
+if __name__ == '__main__':
+    main()
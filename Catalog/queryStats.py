@@ -0,0 +1,168 @@
+"""
+Per-request SQL statistics.
+
+Engine events time every statement and report it to the collectors active
+in the thread: one per request, started before the view and finished at
+teardown so streamed responses are included, and the ones opened by
+assert_max_queries.
+
+For each request the number of statements, their total time and the slowest
+ones are sent in a Server-Timing header and logged as one JSON line by the
+'catalog.queries' logger. A statement shape, i.e. its SQL with IN lists
+collapsed, executed QUERY_REPEAT_THRESHOLD times or more in one request is
+logged as a likely N+1 pattern, e.g. lazy loading Item.image in a loop.
+"""
+
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import config
+from jsonUtil import dumps
+
+logger = logging.getLogger('catalog.queries')
+local = threading.local()
+
+def statement_shape(statement):
+    """Statement with whitespace and IN (...) parameter lists collapsed"""
+    shape = ' '.join(statement.split())
+    return re.sub(r'\((?:\s*(?:\?|%\(\w+\)s|%s|:\w+)\s*,)+\s*(?:\?|%\(\w+\)s|%s|:\w+)\s*\)', '(...)', shape)
+
+class QueryStats(object):
+    """Statements executed while the collector is active
+
+    Attributes:
+        count: number of statements
+        total: seconds spent in them
+        shapes: statement shape -> number of executions
+        slowest: (seconds, shape) of the slowest statements, slowest first
+    """
+    def __init__(self, keep_slowest = config.QUERY_SLOWEST):
+        self.count = 0
+        self.total = 0.0
+        self.shapes = {}
+        self.slowest = []
+        self.keep_slowest = keep_slowest
+
+    def add(self, shape, duration):
+        self.count += 1
+        self.total += duration
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+        if len(self.slowest) < self.keep_slowest or duration > self.slowest[-1][0]:
+            self.slowest.append((duration, shape))
+            self.slowest.sort(key = lambda s: -s[0])
+            del self.slowest[self.keep_slowest:]
+
+    def repeated(self, threshold = None):
+        """(shape, count) of the shapes executed threshold times or more"""
+        threshold = threshold or config.QUERY_REPEAT_THRESHOLD
+        return sorted([(shape, n) for shape, n in self.shapes.items() if n >= threshold],
+                      key = lambda s: -s[1])
+
+    def __enter__(self):
+        collectors().append(self)
+        return self
+
+    def __exit__(self, *exc):
+        collectors().remove(self)
+
+def collectors():
+    """Active collectors of this thread"""
+    if not hasattr(local, 'collectors'):
+        local.collectors = []
+    return local.collectors
+
+# Engine events
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_stats_start = time.time()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    active = collectors()
+    if not active:
+        return
+    duration = time.time() - getattr(context, '_query_stats_start', time.time())
+    shape = statement_shape(statement)
+    for stats in active:
+        stats.add(shape, duration)
+
+def install():
+    """Time the statements of every engine, also the ones not created yet"""
+    if not event.contains(Engine, 'after_cursor_execute', after_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+# Request hooks
+
+def start_request():
+    """before_request: collect the statements of this request"""
+    g.query_stats = QueryStats().__enter__()
+    g.request_start = time.time()
+
+def server_timing(response):
+    """after_request: add the statements so far in a Server-Timing header"""
+    stats = getattr(g, 'query_stats', None)
+    if stats is not None and config.QUERY_SERVER_TIMING:
+        response.headers.add('Server-Timing', 'db;desc="%d queries";dur=%.1f' % (
+            stats.count, stats.total * 1000))
+        response.headers.add('Server-Timing', 'app;dur=%.1f' % (
+            (time.time() - g.request_start) * 1000))
+    return response
+
+def finish_request(exception = None):
+    """teardown_request: log the statistics of the request"""
+    stats = g.pop('query_stats', None)
+    if stats is None:
+        return
+    stats.__exit__()
+    repeated = stats.repeated()
+    for shape, n in repeated:
+        logger.warning('possible N+1 in %s %s: %d times %s', request.method, request.path, n, shape)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(dumps(dict(
+            method = request.method,
+            path = request.path,
+            queries = stats.count,
+            db_ms = round(stats.total * 1000, 1),
+            app_ms = round((time.time() - g.request_start) * 1000, 1),
+            slowest = [dict(ms = round(d * 1000, 1), sql = shape[:200]) for d, shape in stats.slowest],
+            repeated = [dict(count = n, sql = shape[:200]) for shape, n in repeated])))
+
+def init_app(app):
+    """Collect statistics of the requests of app"""
+    if not config.QUERY_STATS:
+        return
+    install()
+    app.before_request(start_request)
+    app.after_request(server_timing)
+    app.teardown_request(finish_request)
+
+# Tests
+
+@contextmanager
+def assert_max_queries(n, max_repeats = None):
+    """Fail if the block executes more than n statements
+
+    Args:
+        max_repeats: also fail if a statement shape is executed more than
+            max_repeats times, i.e. an N+1 pattern
+    Example:
+        with assert_max_queries(1):
+            app.test_client().get('/catalog/category_1/item_2')
+    """
+    with QueryStats() as stats:
+        yield stats
+    if stats.count > n:
+        raise AssertionError('%d queries executed, at most %d expected:\n  %s' % (
+            stats.count, n, '\n  '.join('%d x %s' % (c, s) for s, c in stats.shapes.items())))
+    if max_repeats is not None:
+        repeated = stats.repeated(max_repeats + 1)
+        if repeated:
+            raise AssertionError('statements repeated more than %d times:\n  %s' % (
+                max_repeats, '\n  '.join('%d x %s' % (c, s) for s, c in repeated)))
@@ -0,0 +1,482 @@
+"""
+In-memory inverted index used by /catalog/search, and prefix index used by
+/catalog/suggest.
+
+Item titles, descriptions and category names are tokenized into lowercase
+terms. Each term maps to the items (or categories) containing it, so a query
+only touches the postings of its own terms and never scans the item table.
+
+Query terms match index terms exactly, by prefix, or with one typo. Typo
+candidates are found through a table of "delete-one-letter" variants of every
+term, so no edit distance is computed against the whole vocabulary.
+
+The index is built from the database on first use and then kept up to date
+by the model methods of catalogDB.
+"""
+
+import bisect
+import heapq
+import math
+import re
+import threading
+import unicodedata
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+text_type = type(u'')
+
+# weight of a term found in each field of an item
+TITLE_WEIGHT = 3.0
+CATEGORY_WEIGHT = 2.0
+DESC_WEIGHT = 1.0
+
+# weight of each kind of match between a query term and an index term
+EXACT_MATCH = 1.0
+PREFIX_MATCH = 0.6
+TYPO_MATCH = 0.4
+
+MIN_PREFIX_LEN = 2 # shorter query terms only match exactly
+MIN_TYPO_LEN = 4 # shorter query terms are not corrected
+MAX_EXPANSIONS = 50 # max index terms a query term expands to
+
+def normalize(text):
+    """Lowercase text and strip accents"""
+    if not isinstance(text, text_type):
+        text = text.decode('utf-8', 'replace')
+    text = unicodedata.normalize('NFKD', text.lower())
+    return u''.join(c for c in text if not unicodedata.combining(c))
+
+def tokenize(text):
+    """Split text into a list of normalized terms"""
+    if not text:
+        return []
+    return TOKEN_RE.findall(normalize(text))
+
+def deletes(term):
+    """All strings made by deleting one letter from term"""
+    return set(term[:i] + term[i+1:] for i in range(len(term)))
+
+def within_one_edit(a, b):
+    """Check if a and b differ by at most one insertion, deletion,
+    substitution or transposition of adjacent letters
+    """
+    if a == b:
+        return True
+    la, lb = len(a), len(b)
+    if abs(la - lb) > 1:
+        return False
+    if la > lb:
+        a, b, la, lb = b, a, lb, la
+    i = 0
+    while i < la and a[i] == b[i]:
+        i += 1
+    if la == lb:
+        return a[i+1:] == b[i+1:] or \
+               (a[i+2:] == b[i+2:] and a[i] == b[i+1] and a[i+1] == b[i])
+    return a[i:] == b[i+1:]
+
+def prefix_keys(text):
+    """Keys under which a name can be found by prefix: the whole normalized
+    name and the rest of it starting from each following word
+    """
+    name = u' '.join(tokenize(text))
+    keys = [name]
+    for i, c in enumerate(name):
+        if c == u' ':
+            keys.append(name[i+1:])
+    return keys
+
+class PrefixIndex(object):
+    """Sorted arrays of names for prefix lookups with bisect
+
+    Each kind, 'category' or 'item', has its own array of (key, id) tuples,
+    so categories are found however many item keys share their prefix.
+    Names are kept once in 'names', the arrays only hold their keys.
+    """
+    KINDS = ('category', 'item') # categories are suggested first
+
+    def __init__(self):
+        self.entries = dict((kind, []) for kind in self.KINDS)
+        self.names = {} # (kind, id) -> (name, keys)
+
+    def add(self, kind, row_id, name, sort = True):
+        """Add or replace a name
+
+        Args:
+            sort: False to append the keys unsorted when building, sort()
+                must then be called once all names are added
+        """
+        self.remove(kind, row_id)
+        keys = prefix_keys(name)
+        entries = self.entries[kind]
+        for key in keys:
+            if sort:
+                bisect.insort(entries, (key, row_id))
+            else:
+                entries.append((key, row_id))
+        self.names[(kind, row_id)] = (name, keys)
+
+    def sort(self):
+        for entries in self.entries.values():
+            entries.sort()
+
+    def remove(self, kind, row_id):
+        name_keys = self.names.pop((kind, row_id), None)
+        if name_keys is None:
+            return
+        entries = self.entries[kind]
+        for key in name_keys[1]:
+            i = bisect.bisect_left(entries, (key, row_id))
+            if i < len(entries) and entries[i] == (key, row_id):
+                del entries[i]
+
+    def lookup(self, prefix, k = 10, scan = 200):
+        """Find names starting with prefix, or with a word starting with it
+
+        At most 'scan' entries of each kind are read. Categories rank first,
+        then whole-name matches before word matches, then shorter names.
+
+        Returns:
+            list of at most k (kind, id, name) tuples
+        """
+        prefix = u' '.join(tokenize(prefix))
+        if not prefix:
+            return []
+        found = {}
+        for kind in self.KINDS:
+            entries = self.entries[kind]
+            i = bisect.bisect_left(entries, (prefix,))
+            end = min(len(entries), i + scan)
+            while i < end:
+                key, row_id = entries[i]
+                if not key.startswith(prefix):
+                    break
+                name, keys = self.names[(kind, row_id)]
+                rank = (self.KINDS.index(kind), key != keys[0], len(name), name)
+                if (kind, row_id) not in found or rank < found[(kind, row_id)][0]:
+                    found[(kind, row_id)] = (rank, name)
+                i += 1
+        best = sorted((rank, kind, row_id, name) for (kind, row_id), (rank, name) in found.items())
+        return [(kind, row_id, name) for rank, kind, row_id, name in best[:k]]
+
+class SearchResult(object):
+    """One page of search results
+
+    Attributes:
+        item_ids: ids of matched items in this page, best first
+        category_ids: ids of categories whose name matches the query
+        total: number of matched items
+        page: page number, starts from 1
+        per_page: max number of items in a page
+    """
+    def __init__(self, item_ids, category_ids, total, page, per_page):
+        self.item_ids = item_ids
+        self.category_ids = category_ids
+        self.total = total
+        self.page = page
+        self.per_page = per_page
+
+    @property
+    def pages(self):
+        return max(1, (self.total + self.per_page - 1) // self.per_page)
+
+class SearchIndex(object):
+    """Inverted index of items and categories
+
+    Attributes:
+        loader: function returning (category rows, item rows) used to build
+            the index. Category rows have id and name, item rows have id,
+            title, desc and category_id.
+        loaded: True after the index has been built
+        building: True while the index is being built
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self.loaded = False
+        self.building = False
+        self.lock = threading.RLock()
+        self.pending_lock = threading.Lock()
+        self.pending = [] # writes made while building, (function, args)
+        self.clear()
+
+    def clear(self):
+        self.item_postings = {} # term -> {item_id: weight}
+        self.category_postings = {} # term -> {category_id: weight}
+        self.item_terms = {} # item_id -> terms, used for removal
+        self.category_terms = {} # category_id -> terms
+        self.item_category = {} # item_id -> category_id
+        self.category_items = {} # category_id -> set of item_ids
+        self.vocabulary = [] # sorted terms, used for prefix matching
+        self.typo_table = {} # term with one letter deleted -> set of terms
+        self.suggestions = PrefixIndex() # item titles and category names
+
+    def ensure_loaded(self):
+        """Build the index from the loader if it hasn't been built
+
+        Terms and prefix keys are appended unsorted and sorted once at the
+        end. Writes made meanwhile are recorded and applied after the rows
+        of the loader, so none of them is lost, whether or not the loader
+        saw its row.
+        """
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            with self.pending_lock:
+                self.building = True
+            try:
+                self.clear()
+                categories, items = self.loader()
+                for c in categories:
+                    self._add_category(c.id, c.name)
+                for i in items:
+                    self._add_item(i.id, i.title, i.desc, i.category_id)
+                self.vocabulary.sort()
+                self.suggestions.sort()
+            except:
+                self.clear()
+                raise
+            finally:
+                with self.pending_lock:
+                    pending, self.pending = self.pending, []
+                    self.building = False
+            for func, a in pending:
+                func(*a)
+            self.loaded = True
+
+    def _write(self, func, *a):
+        """Apply a write to the index
+
+        It is recorded if the index is being built, and dropped if the index
+        isn't loaded, the next build reads the row from the database.
+        """
+        with self.pending_lock:
+            if self.building:
+                self.pending.append((func, a))
+                return
+        with self.lock:
+            if self.loaded:
+                func(*a)
+
+    # Vocabulary
+
+    def _add_term(self, term):
+        if term in self.item_postings or term in self.category_postings:
+            return
+        if self.building:
+            self.vocabulary.append(term) # sorted at the end of the build
+        else:
+            bisect.insort(self.vocabulary, term)
+        for d in deletes(term):
+            self.typo_table.setdefault(d, set()).add(term)
+
+    def _remove_term(self, term):
+        if term in self.item_postings or term in self.category_postings:
+            return
+        i = bisect.bisect_left(self.vocabulary, term)
+        if i < len(self.vocabulary) and self.vocabulary[i] == term:
+            del self.vocabulary[i]
+        for d in deletes(term):
+            terms = self.typo_table.get(d)
+            if terms:
+                terms.discard(term)
+                if not terms:
+                    del self.typo_table[d]
+
+    def _post(self, postings, key, weights):
+        for term, weight in weights.items():
+            self._add_term(term)
+            postings.setdefault(term, {})[key] = weight
+
+    def _unpost(self, postings, key, terms):
+        for term in terms:
+            docs = postings.get(term)
+            if docs is None:
+                continue
+            docs.pop(key, None)
+            if not docs:
+                del postings[term]
+                self._remove_term(term)
+
+    # Updates
+
+    def _add_item(self, item_id, title, desc, category_id):
+        self._remove_item(item_id)
+        weights = {}
+        for field, weight in ((title, TITLE_WEIGHT), (desc, DESC_WEIGHT)):
+            for term in tokenize(field):
+                weights[term] = weights.get(term, 0.0) + weight
+        self._post(self.item_postings, item_id, weights)
+        self.item_terms[item_id] = list(weights)
+        self.item_category[item_id] = category_id
+        self.category_items.setdefault(category_id, set()).add(item_id)
+        self.suggestions.add('item', item_id, title, sort = not self.building)
+
+    def _remove_item(self, item_id):
+        terms = self.item_terms.pop(item_id, None)
+        if terms is None:
+            return
+        self._unpost(self.item_postings, item_id, terms)
+        category_id = self.item_category.pop(item_id)
+        items = self.category_items.get(category_id)
+        if items is not None:
+            items.discard(item_id)
+        self.suggestions.remove('item', item_id)
+
+    def _add_category(self, category_id, name):
+        self._unpost(self.category_postings, category_id,
+                     self.category_terms.pop(category_id, ()))
+        weights = {}
+        for term in tokenize(name):
+            weights[term] = weights.get(term, 0.0) + CATEGORY_WEIGHT
+        self._post(self.category_postings, category_id, weights)
+        self.category_terms[category_id] = list(weights)
+        self.suggestions.add('category', category_id, name, sort = not self.building)
+
+    def add_item(self, item):
+        """Index a new item or reindex a changed one"""
+        self._write(self._add_item, item.id, item.title, item.desc, item.category_id)
+
+    def remove_item(self, item_id):
+        self._write(self._remove_item, item_id)
+
+    def remove_items(self, item_ids):
+        self._write(self._remove_items, list(item_ids))
+
+    def _remove_items(self, item_ids):
+        for item_id in item_ids:
+            self._remove_item(item_id)
+
+    def remove_category_items(self, category_id):
+        """Remove all items of a category, but not the category"""
+        self._write(self._remove_category_items, category_id)
+
+    def _remove_category_items(self, category_id):
+        for item_id in list(self.category_items.pop(category_id, ())):
+            self._remove_item(item_id)
+
+    def reset(self):
+        """Drop the index, the next search builds it again
+
+        Used after bulk updates, whose rows aren't loaded.
+        """
+        with self.lock:
+            self.loaded = False
+            self.clear()
+
+    def add_category(self, category):
+        """Index a new category or reindex a renamed one"""
+        self._write(self._add_category, category.id, category.name)
+
+    def remove_category(self, category_id):
+        """Remove a category and all its items"""
+        self._write(self._remove_category, category_id)
+
+    def _remove_category(self, category_id):
+        self._remove_category_items(category_id)
+        self._unpost(self.category_postings, category_id,
+                     self.category_terms.pop(category_id, ()))
+        self.suggestions.remove('category', category_id)
+
+    # Query
+
+    def expand(self, term):
+        """Find index terms matching a query term
+
+        Returns:
+            dict of index term -> match weight
+        """
+        matches = {}
+        if term in self.item_postings or term in self.category_postings:
+            matches[term] = EXACT_MATCH
+        if len(term) >= MIN_PREFIX_LEN:
+            i = bisect.bisect_right(self.vocabulary, term)
+            while i < len(self.vocabulary) and len(matches) < MAX_EXPANSIONS:
+                t = self.vocabulary[i]
+                if not t.startswith(term):
+                    break
+                matches[t] = PREFIX_MATCH
+                i += 1
+        if len(term) >= MIN_TYPO_LEN:
+            candidates = set(self.typo_table.get(term, ()))
+            for d in deletes(term):
+                candidates.update(self.typo_table.get(d, ()))
+                if d in self.item_postings or d in self.category_postings:
+                    candidates.add(d)
+            for t in candidates:
+                if len(matches) >= MAX_EXPANSIONS:
+                    break
+                if t not in matches and within_one_edit(term, t):
+                    matches[t] = TYPO_MATCH
+        return matches
+
+    def idf(self, term):
+        df = len(self.item_postings.get(term, ())) + \
+             len(self.category_postings.get(term, ()))
+        return math.log(1.0 + float(len(self.item_category) + 1) / (df + 1))
+
+    def score_term(self, term):
+        """Score every item matched by one query term
+
+        Returns:
+            (dict of item_id -> score, set of matched category ids)
+        """
+        scores = {}
+        categories = set()
+        for t, match in self.expand(term).items():
+            w = match * self.idf(t)
+            for item_id, weight in self.item_postings.get(t, {}).items():
+                scores[item_id] = max(scores.get(item_id, 0.0), w * weight)
+            for category_id, weight in self.category_postings.get(t, {}).items():
+                categories.add(category_id)
+                for item_id in self.category_items.get(category_id, ()):
+                    scores[item_id] = max(scores.get(item_id, 0.0), w * weight)
+        return scores, categories
+
+    def search(self, q, page = 1, per_page = 12):
+        """Search items and categories
+
+        Every query term must match an item, in its title, description or
+        category name. Items are ranked by the sum of their term scores.
+
+        Args:
+            q: query string
+            page: page number, starts from 1
+            per_page: page size
+        Returns:
+            SearchResult
+        """
+        self.ensure_loaded()
+        terms = tokenize(q)
+        page = max(1, page)
+        if not terms:
+            return SearchResult([], [], 0, page, per_page)
+
+        with self.lock:
+            per_term = [self.score_term(t) for t in set(terms)]
+        per_term.sort(key = lambda x: len(x[0]))
+        scores = dict(per_term[0][0])
+        categories = set(per_term[0][1])
+        for term_scores, term_categories in per_term[1:]:
+            categories &= term_categories
+            for item_id in list(scores):
+                s = term_scores.get(item_id)
+                if s is None:
+                    del scores[item_id]
+                else:
+                    scores[item_id] += s
+
+        end = page * per_page
+        best = heapq.nlargest(end, scores.items(), key = lambda x: (x[1], x[0]))
+        item_ids = [item_id for item_id, score in best[end - per_page:end]]
+        return SearchResult(item_ids, sorted(categories), len(scores), page, per_page)
+
+    def suggest(self, prefix, k = 10):
+        """Complete a prefix to item titles and category names
+
+        Returns:
+            list of at most k (kind, id, name) tuples
+        """
+        self.ensure_loaded()
+        with self.lock:
+            return self.suggestions.lookup(prefix, k)
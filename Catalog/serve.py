@@ -0,0 +1,120 @@
+"""
+Production server: the app in gunicorn worker processes.
+
+    python Catalog/serve.py
+
+The settings are the SERVER_* ones of config.py, e.g.
+CATALOG_SERVER_WORKERS=9 CATALOG_SERVER_THREADS=4 python Catalog/serve.py
+
+Each worker process serves SERVER_THREADS requests at a time with its own
+database pools. Connections are never shared between processes. Workers
+import the app themselves after the fork, or, with SERVER_PRELOAD, the
+master's connections are closed before each fork and the worker drops any
+left. A worker is replaced after SERVER_MAX_REQUESTS requests, which bounds
+the growth of its caches.
+
+Signals to the master process:
+    HUP   start new workers with the current code and settings, then stop
+          the old ones once they finish their requests (with SERVER_PRELOAD
+          only the settings are reloaded, use USR2 to load new code)
+    TERM  stop gracefully, waiting up to SERVER_GRACEFUL_TIMEOUT seconds
+    TTIN, TTOU  add or remove a worker
+
+With several workers the metrics of /metrics are shared through
+METRICS_DIR, a temporary folder unless it is set. It is emptied at startup.
+The fragment cache tag versions are shared through CACHE_TAG_DIR, also a
+temporary folder unless it is set, so a write invalidates the cached
+fragments and validators of every worker.
+"""
+
+import glob
+import multiprocessing
+import os
+import sys
+import tempfile
+
+from gunicorn.app.base import BaseApplication
+
+import config
+
+APP_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+def worker_count():
+    return config.SERVER_WORKERS or multiprocessing.cpu_count() * 2 + 1
+
+def prepare_metrics_dir(workers):
+    """Empty METRICS_DIR for the workers, create a temporary one if unset"""
+    if not config.METRICS_ENABLED or workers < 2:
+        return
+    if not config.METRICS_DIR:
+        config.METRICS_DIR = tempfile.mkdtemp(prefix = 'catalog-metrics-')
+        os.environ['CATALOG_METRICS_DIR'] = config.METRICS_DIR # seen by the workers
+    elif not os.path.isdir(config.METRICS_DIR):
+        os.makedirs(config.METRICS_DIR)
+    for path in glob.glob(os.path.join(config.METRICS_DIR, '*')):
+        os.remove(path)
+
+def prepare_cache_tag_dir(workers):
+    """Create a temporary CACHE_TAG_DIR for the workers if unset"""
+    if workers < 2 or config.CACHE_TAG_DIR:
+        return
+    config.CACHE_TAG_DIR = tempfile.mkdtemp(prefix = 'catalog-cache-tags-')
+    os.environ['CATALOG_CACHE_TAG_DIR'] = config.CACHE_TAG_DIR # seen by the workers
+
+def pre_fork(server, worker):
+    """Close the connections of a preloaded app before forking"""
+    database = sys.modules.get('Catalog.database')
+    if database is not None:
+        database.dispose_engines()
+
+def post_fork(server, worker):
+    """Drop what a preloaded app inherited from the master"""
+    database = sys.modules.get('Catalog.database')
+    if database is not None:
+        database.dispose_engines()
+    catalogDB = sys.modules.get('Catalog.catalogDB')
+    if catalogDB is not None:
+        catalogDB.image_ingestor.after_fork()
+
+def worker_exit(server, worker):
+    """Write the last metrics of the worker for the others"""
+    metrics = sys.modules.get('Catalog.metrics')
+    if metrics is not None and config.METRICS_ENABLED and config.METRICS_DIR:
+        metrics.flush()
+
+def options():
+    """gunicorn settings"""
+    return dict(
+        bind = config.SERVER_BIND,
+        workers = worker_count(),
+        threads = config.SERVER_THREADS,
+        worker_class = config.SERVER_THREADS > 1 and 'gthread' or 'sync',
+        max_requests = config.SERVER_MAX_REQUESTS,
+        max_requests_jitter = config.SERVER_MAX_REQUESTS_JITTER,
+        timeout = config.SERVER_TIMEOUT,
+        graceful_timeout = config.SERVER_GRACEFUL_TIMEOUT,
+        keepalive = config.SERVER_KEEPALIVE,
+        preload_app = config.SERVER_PRELOAD,
+        chdir = APP_FOLDER, # static/images is relative to it
+        pre_fork = pre_fork,
+        post_fork = post_fork,
+        worker_exit = worker_exit,
+    )
+
+class CatalogServer(BaseApplication):
+    def load_config(self):
+        for name, value in options().items():
+            self.cfg.set(name, value)
+
+    def load(self):
+        from Catalog import create_app
+        return create_app()
+
+def main():
+    sys.path.insert(0, os.path.dirname(APP_FOLDER)) # to import the Catalog package
+    prepare_metrics_dir(worker_count())
+    prepare_cache_tag_dir(worker_count())
+    CatalogServer().run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+"""
+Per-route benchmark of the catalog app.
+
+    python benchmarks/bench.py [--items 100000] [--categories 50] [--output FILE]
+
+A synthetic catalog is seeded into a throwaway database, by default a SQLite
+file in the temp folder, or the database given by --database-url, e.g. an
+empty PostgreSQL database. It is seeded again only when its size differs
+from --items and --categories, or with --reseed.
+
+Every read route is then driven in two modes:
+
+    client: sequential requests through the Flask test client, no network
+    http: --concurrency threads sending keep-alive requests for --duration
+        seconds to the app served in process by a threaded WSGI server, or to
+        --url, e.g. a gunicorn started separately
+
+Each result has the p50/p95/p99 latency, the throughput and the number of
+SQL queries per request (not known with --url). Results are written as JSON
+with the commit, the database and the catalog size, and two result files
+are compared with benchmarks/compare.py.
+"""
+
+import argparse
+import datetime
+import httplib
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = ('red blue green black white silver compact sport classic electric '
+         'vintage turbo hybrid diesel luxury family city travel mountain road '
+         'coupe sedan wagon roadster cabrio van truck bike scooter boat').split()
+BENCH_USER = 'bench'
+BENCH_PASSWORD = 'bench-password'
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of sorted values"""
+    if not sorted_values:
+        return None
+    k = int(math.ceil(p / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(0, k)]
+
+def to_ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+def summarize(route, mode, latencies, errors, elapsed, queries):
+    """Result dict of one route, latencies in seconds"""
+    latencies = sorted(latencies)
+    n = len(latencies)
+    return dict(route = route, mode = mode, requests = n, errors = errors,
+                p50_ms = to_ms(percentile(latencies, 50)),
+                p95_ms = to_ms(percentile(latencies, 95)),
+                p99_ms = to_ms(percentile(latencies, 99)),
+                mean_ms = to_ms(n and sum(latencies) / n or None),
+                throughput_rps = round(n / elapsed, 1) if elapsed else None,
+                queries_per_request = round(float(queries) / n, 2) if n and queries is not None else None)
+
+# Seeding
+
+def seed(items, categories, rng, batch_size = 5000):
+    """Fill an empty database with a synthetic catalog"""
+    from Catalog.catalogImport import Importer
+    from Catalog.catalogDB import User
+    from Catalog.database import unit_of_work
+    from Catalog.loginManager import make_password
+
+    importer = Importer(images = False)
+    batch = []
+    for i in range(items):
+        words = rng.sample(WORDS, 3)
+        batch.append(dict(ext_id = 'bench-%d' % i,
+                          category = 'Category %d' % (i % categories),
+                          title = '%s %s %d' % (words[0].title(), words[1], i),
+                          desc = ' '.join(rng.sample(WORDS, 8)),
+                          img_url = None))
+        if len(batch) >= batch_size:
+            importer.import_batch(batch)
+            batch = []
+    if batch:
+        importer.import_batch(batch)
+    with unit_of_work():
+        User.store(BENCH_USER, make_password(BENCH_USER, BENCH_PASSWORD), None)
+
+def prepare_database(args, rng):
+    """Seed the database unless it already has the requested catalog"""
+    from Catalog.catalogDB import Base, Category, Item, session
+    from Catalog.database import get_engine
+    from Catalog import migrations
+
+    migrations.upgrade()
+    have = (session.query(Item).count(), session.query(Category).count())
+    session.remove()
+    if not args.reseed and have == (args.items, args.categories):
+        return 0
+    Base.metadata.drop_all(get_engine())
+    migrations.schema_version.drop(get_engine(), checkfirst = True)
+    migrations.upgrade()
+    start = time.time()
+    seed(args.items, args.categories, rng)
+    session.remove()
+    return time.time() - start
+
+def sample_routes(rng):
+    """(name, method, path, form, logged in) of the read routes"""
+    from Catalog.catalogDB import Category, Item, session
+
+    category_id = session.query(Category.id).order_by(Category.id).first()[0]
+    item_ids = [r[0] for r in session.query(Item.id).order_by(Item.id).limit(1000)]
+    item = session.query(Item).filter_by(id = rng.choice(item_ids)).one()
+    page = Item.get_page(category_id)
+    item_path = '/catalog/category_%s/item_%s' % (item.category_id, item.id)
+    session.remove()
+    login_form = dict(username = BENCH_USER, password = BENCH_PASSWORD, next_url = '/catalog/')
+    return [
+        ('home', 'GET', '/catalog/', None, False),
+        ('home logged in', 'GET', '/catalog/', None, True),
+        ('category', 'GET', '/catalog/category_%s/' % category_id, None, False),
+        ('category page 2', 'GET', '/catalog/category_%s/?after=%s' % (category_id, page.next_cursor or ''), None, False),
+        ('item', 'GET', item_path, None, False),
+        ('search', 'GET', '/catalog/search?q=%s+%s' % (WORDS[0], WORDS[11][:4]), None, False),
+        ('search typo', 'GET', '/catalog/search?q=%s' % WORDS[5].replace('e', 'a', 1), None, False),
+        ('suggest', 'GET', '/catalog/suggest?q=%s' % WORDS[3][:3], None, False),
+        ('catalog json', 'GET', '/catalog.json', None, False),
+        ('category json', 'GET', '/catalog/category_%s.json' % category_id, None, False),
+        ('item json', 'GET', item_path + '.json', None, False),
+        ('catalog xml', 'GET', '/catalog.xml', None, False),
+        ('export json', 'GET', '/catalog/export.json', None, False),
+        ('login page', 'GET', '/catalog/login/', None, False),
+        ('login', 'POST', '/catalog/login/', login_form, False),
+    ]
+
+# Drivers
+
+class QueryCounter(object):
+    """Counts the SQL statements executed by an engine"""
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        self.lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+
+    def before_cursor_execute(self, *a):
+        with self.lock:
+            self.count += 1
+
+def login_cookie(app):
+    """Cookie header value of the benchmark user"""
+    response = app.test_client().post('/catalog/login/', data = dict(
+        username = BENCH_USER, password = BENCH_PASSWORD, next_url = '/catalog/'))
+    cookie = response.headers.get('Set-Cookie')
+    if not cookie:
+        sys.exit('login of the benchmark user failed')
+    return cookie.split(';')[0]
+
+def run_client(app, counter, routes, cookie, requests, warmup):
+    """Sequential requests through the Flask test client"""
+    results = []
+    for name, method, path, form, logged_in in routes:
+        client = app.test_client()
+        headers = logged_in and {'Cookie': cookie} or {}
+        def send():
+            response = client.open(path, method = method, data = form, headers = headers)
+            response.get_data() # consume streamed bodies
+            return response.status_code < 400
+        for i in range(warmup):
+            send()
+        latencies = []
+        errors = 0
+        queries = counter.count
+        start = time.time()
+        for i in range(requests):
+            t = time.time()
+            if not send():
+                errors += 1
+            latencies.append(time.time() - t)
+        elapsed = time.time() - start
+        results.append(summarize(name, 'client', latencies, errors, elapsed, counter.count - queries))
+    return results
+
+class LoadWorker(threading.Thread):
+    """Sends requests over a keep-alive connection until deadline, or until
+    max_requests are sent if it is given
+    """
+    def __init__(self, netloc, method, path, body, headers, deadline, max_requests = None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.netloc = netloc
+        self.request = (method, path, body, headers)
+        self.deadline = deadline
+        self.max_requests = max_requests
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        conn = None
+        while time.time() < self.deadline and \
+              (self.max_requests is None or len(self.latencies) + self.errors < self.max_requests):
+            if conn is None:
+                conn = httplib.HTTPConnection(self.netloc, timeout = 30)
+            t = time.time()
+            try:
+                conn.request(*self.request)
+                response = conn.getresponse()
+                response.read()
+                if response.status >= 400:
+                    self.errors += 1
+                if response.will_close:
+                    conn.close()
+                    conn = None
+            except (httplib.HTTPException, EnvironmentError):
+                self.errors += 1
+                conn.close()
+                conn = None
+                continue
+            self.latencies.append(time.time() - t)
+        if conn is not None:
+            conn.close()
+
+def run_http(base_url, counter, routes, cookie, concurrency, duration, warmup):
+    """Concurrent keep-alive load on every route for duration seconds"""
+    netloc = urlparse.urlsplit(base_url).netloc
+    results = []
+    for name, method, path, form, logged_in in routes:
+        headers = {}
+        body = None
+        if logged_in:
+            headers['Cookie'] = cookie
+        if form:
+            body = '&'.join('%s=%s' % item for item in sorted(form.items()))
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        LoadWorker(netloc, method, path, body, headers, time.time() + duration, warmup).run()
+
+        queries = counter and counter.count
+        start = time.time()
+        workers = [LoadWorker(netloc, method, path, body, headers, start + duration)
+                   for i in range(concurrency)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = time.time() - start
+        latencies = [l for w in workers for l in w.latencies]
+        results.append(summarize(name, 'http', latencies, sum(w.errors for w in workers), elapsed,
+                                 counter and counter.count - queries))
+    return results
+
+def serve(app):
+    """Serve app from a threaded WSGI server in a thread
+
+    Returns:
+        the server, stopped by its shutdown method
+    """
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1' # keep-alive
+    WSGIRequestHandler.log_request = lambda *a, **kw: None
+    server = make_server('127.0.0.1', 0, app, threaded = True)
+    # accepted sockets inherit it, else headers and body written separately
+    # wait for the delayed ACK of the client (~40ms per response)
+    server.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+# Report
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = ROOT).strip()
+    except (EnvironmentError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results):
+    print('%-18s %-6s %8s %6s %9s %9s %9s %9s %8s' % (
+        'route', 'mode', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'queries'))
+    for r in results:
+        print('%-18s %-6s %8d %6d %9s %9s %9s %9s %8s' % (
+            r['route'], r['mode'], r['requests'], r['errors'], r['p50_ms'], r['p95_ms'],
+            r['p99_ms'], r['throughput_rps'], r['queries_per_request']))
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark the catalog routes')
+    parser.add_argument('--items', type = int, default = 1000)
+    parser.add_argument('--categories', type = int, default = 20)
+    parser.add_argument('--database-url', default = 'sqlite:///' + os.path.join(
+        tempfile.gettempdir(), 'catalog-bench.db'))
+    parser.add_argument('--reseed', action = 'store_true', help = 'seed even if the size matches')
+    parser.add_argument('--mode', choices = ('client', 'http', 'both'), default = 'both')
+    parser.add_argument('--requests', type = int, default = 200, help = 'requests per route, client mode')
+    parser.add_argument('--concurrency', type = int, default = 8, help = 'threads, http mode')
+    parser.add_argument('--duration', type = float, default = 5, help = 'seconds per route, http mode')
+    parser.add_argument('--warmup', type = int, default = 5, help = 'requests per route before measuring')
+    parser.add_argument('--url', help = 'load an external server instead, http mode')
+    parser.add_argument('--routes', help = 'comma separated route names to run')
+    parser.add_argument('--no-cache', action = 'store_true', help = 'disable the fragment cache')
+    parser.add_argument('--seed', type = int, default = 1, help = 'random seed of the synthetic data')
+    parser.add_argument('--output', help = 'write results as JSON to this file')
+    args = parser.parse_args(argv)
+    output = args.output and os.path.abspath(args.output)
+
+    os.environ['CATALOG_DATABASE_URL'] = args.database_url
+    sys.path.insert(0, ROOT)
+    os.chdir(os.path.join(ROOT, 'Catalog'))
+    from Catalog import create_app
+    from Catalog.database import get_engine
+    from Catalog.fragmentCache import fragment_cache
+    import sqlalchemy
+
+    app = create_app()
+    rng = random.Random(args.seed)
+    seed_seconds = prepare_database(args, rng)
+    if seed_seconds:
+        print('seeded %d items in %d categories in %.1fs' % (args.items, args.categories, seed_seconds))
+    fragment_cache.enabled = not args.no_cache
+
+    routes = sample_routes(rng)
+    if args.routes:
+        names = set(args.routes.split(','))
+        routes = [r for r in routes if r[0] in names]
+    counter = QueryCounter(get_engine())
+    cookie = login_cookie(app)
+
+    results = []
+    if args.mode in ('client', 'both') and not args.url:
+        results += run_client(app, counter, routes, cookie, args.requests, args.warmup)
+    if args.mode in ('http', 'both'):
+        if args.url:
+            results += run_http(args.url, None, routes, cookie,
+                                args.concurrency, args.duration, args.warmup)
+        else:
+            server = serve(app)
+            try:
+                results += run_http('http://127.0.0.1:%d' % server.server_port, counter, routes,
+                                    cookie, args.concurrency, args.duration, args.warmup)
+            finally:
+                server.shutdown()
+    print_results(results)
+
+    if output:
+        report = dict(
+            meta = dict(commit = git_commit(),
+                        date = datetime.datetime.utcnow().isoformat() + 'Z',
+                        python = platform.python_version(),
+                        sqlalchemy = sqlalchemy.__version__,
+                        database = get_engine().dialect.name,
+                        url = args.url,
+                        items = args.items,
+                        categories = args.categories,
+                        fragment_cache = not args.no_cache,
+                        concurrency = args.concurrency,
+                        seed = args.seed),
+            results = results)
+        with open(output, 'w') as f:
+            json.dump(report, f, indent = 2, sort_keys = True)
+        print('results written to %s' % output)
+
+if __name__ == '__main__':
+    main()
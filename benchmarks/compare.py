@@ -0,0 +1,88 @@
+"""
+Compare two result files of bench.py.
+
+    python benchmarks/compare.py BASE.json NEW.json [--threshold 10] [--fail]
+
+Routes are matched by name and mode. A route regresses when its p95 latency
+grows, or its throughput drops, by more than --threshold percent, or when it
+needs more queries per request. With --fail the exit status is 1 if a route
+regressed.
+"""
+
+import argparse
+import json
+import sys
+
+# settings which must be the same for the results to be comparable
+SAME_META = ('database', 'items', 'categories', 'fragment_cache', 'concurrency', 'url')
+
+def change(base, new):
+    """Relative change in percent, None if it can't be computed"""
+    if base is None or new is None or not base:
+        return None
+    return 100.0 * (new - base) / base
+
+def regressions(base, new, threshold):
+    """Reasons why new is worse than base"""
+    reasons = []
+    p95 = change(base['p95_ms'], new['p95_ms'])
+    if p95 is not None and p95 > threshold:
+        reasons.append('p95 +%.0f%%' % p95)
+    rps = change(base['throughput_rps'], new['throughput_rps'])
+    if rps is not None and rps < -threshold:
+        reasons.append('throughput %.0f%%' % rps)
+    if None not in (base['queries_per_request'], new['queries_per_request']) and \
+       new['queries_per_request'] > base['queries_per_request']:
+        reasons.append('queries %s -> %s' % (base['queries_per_request'], new['queries_per_request']))
+    if new['errors'] > base['errors']:
+        reasons.append('errors %d -> %d' % (base['errors'], new['errors']))
+    return reasons
+
+def fmt(value, delta):
+    if value is None:
+        return '-'
+    if delta is None:
+        return '%s' % value
+    return '%s (%+.0f%%)' % (value, delta)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Compare two benchmark result files')
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type = float, default = 10,
+                        help = 'percent of change counted as a regression')
+    parser.add_argument('--fail', action = 'store_true', help = 'exit with 1 if a route regressed')
+    args = parser.parse_args(argv)
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print('base %s, new %s' % (base['meta'].get('commit'), new['meta'].get('commit')))
+    for key in SAME_META:
+        if base['meta'].get(key) != new['meta'].get(key):
+            print('warning: %s differs, %r and %r' % (key, base['meta'].get(key), new['meta'].get(key)))
+
+    base_results = dict(((r['route'], r['mode']), r) for r in base['results'])
+    regressed = 0
+    print('%-18s %-6s %-20s %-20s %-20s %s' % ('route', 'mode', 'p50 ms', 'p95 ms', 'req/s', 'queries'))
+    for r in new['results']:
+        b = base_results.get((r['route'], r['mode']))
+        if b is None:
+            print('%-18s %-6s new route' % (r['route'], r['mode']))
+            continue
+        reasons = regressions(b, r, args.threshold)
+        regressed += bool(reasons)
+        print('%-18s %-6s %-20s %-20s %-20s %-8s %s' % (
+            r['route'], r['mode'],
+            fmt(r['p50_ms'], change(b['p50_ms'], r['p50_ms'])),
+            fmt(r['p95_ms'], change(b['p95_ms'], r['p95_ms'])),
+            fmt(r['throughput_rps'], change(b['throughput_rps'], r['throughput_rps'])),
+            r['queries_per_request'],
+            reasons and 'REGRESSED: ' + ', '.join(reasons) or ''))
+    print('%d of %d routes regressed' % (regressed, len(new['results'])))
+    if args.fail and regressed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
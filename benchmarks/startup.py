@@ -0,0 +1,123 @@
+"""
+Startup time of the app.
+
+    python benchmarks/startup.py [--runs 5] [--output FILE]
+
+Every run is a new Python process which times:
+
+    import: import of the Catalog package. It must not create an engine,
+        one created anyway is counted as an error.
+    create_app: create_app(), which loads the templates from the bytecode
+        cache, or compiles them into it for 'create_app cold'
+    first request: the first request of the home page, which connects to
+        the database and renders it
+
+The database is the one of bench.py by default, its schema is upgraded
+first. Results have the format of bench.py, so the startup of two commits
+is compared with benchmarks/compare.py.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench import ROOT, git_commit, print_results, summarize
+
+PHASES = ('import', 'create_app cold', 'create_app', 'first request')
+
+def child(cache_dir):
+    """Time the startup phases in this process and print them as JSON"""
+    os.environ['CATALOG_TEMPLATE_CACHE_DIR'] = cache_dir
+    sys.path.insert(0, ROOT)
+    os.chdir(os.path.join(ROOT, 'Catalog'))
+
+    start = time.time()
+    import Catalog
+    import_seconds = time.time() - start
+    from Catalog import database
+    from Catalog.queryStats import QueryStats
+    engines_at_import = len(database.all_engines())
+
+    start = time.time()
+    app = Catalog.create_app()
+    create_seconds = time.time() - start
+
+    with QueryStats() as stats:
+        start = time.time()
+        response = app.test_client().get('/catalog/')
+        request_seconds = time.time() - start
+    print(json.dumps(dict(import_seconds = import_seconds,
+                          engines_at_import = engines_at_import,
+                          create_seconds = create_seconds,
+                          request_seconds = request_seconds,
+                          request_ok = response.status_code == 200,
+                          request_queries = stats.count)))
+
+def run_child(cache_dir):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', cache_dir])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Measure the startup time of the app')
+    parser.add_argument('--runs', type = int, default = 5, help = 'processes started per phase')
+    parser.add_argument('--database-url', default = 'sqlite:///' + os.path.join(
+        tempfile.gettempdir(), 'catalog-bench.db'))
+    parser.add_argument('--output', help = 'write results as JSON to this file')
+    parser.add_argument('--child', metavar = 'CACHE_DIR', help = argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        return child(args.child)
+
+    os.environ['CATALOG_DATABASE_URL'] = args.database_url
+    subprocess.check_call([sys.executable, os.path.join(ROOT, 'Catalog', 'migrations.py'), 'upgrade'])
+
+    latencies = dict((phase, []) for phase in PHASES)
+    errors = dict((phase, 0) for phase in PHASES)
+    queries = 0
+    warm_dir = tempfile.mkdtemp(prefix = 'catalog-startup-')
+    try:
+        run_child(warm_dir) # fills the bytecode cache
+        for i in range(args.runs):
+            cold_dir = tempfile.mkdtemp(prefix = 'catalog-startup-')
+            try:
+                cold = run_child(cold_dir)
+            finally:
+                shutil.rmtree(cold_dir)
+            latencies['create_app cold'].append(cold['create_seconds'])
+
+            warm = run_child(warm_dir)
+            latencies['import'].append(warm['import_seconds'])
+            errors['import'] += warm['engines_at_import']
+            latencies['create_app'].append(warm['create_seconds'])
+            latencies['first request'].append(warm['request_seconds'])
+            errors['first request'] += not warm['request_ok']
+            queries += warm['request_queries']
+    finally:
+        shutil.rmtree(warm_dir)
+
+    results = [summarize(phase, 'startup', latencies[phase], errors[phase], None,
+                         queries if phase == 'first request' else None)
+               for phase in PHASES]
+    print_results(results)
+
+    if args.output:
+        report = dict(
+            meta = dict(commit = git_commit(),
+                        date = datetime.datetime.utcnow().isoformat() + 'Z',
+                        python = platform.python_version(),
+                        database = args.database_url.split(':')[0],
+                        runs = args.runs),
+            results = results)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 2, sort_keys = True)
+        print('results written to %s' % args.output)
+
+if __name__ == '__main__':
+    main()
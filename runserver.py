@@ -1,3 +1,3 @@
-from Catalog import app
+from Catalog import create_app
 if __name__ == '__main__':
-    app.run(host = '0.0.0.0')
+    create_app().run(host = '0.0.0.0')
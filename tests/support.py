@@ -0,0 +1,62 @@
+"""
+Temporary SQLite databases for the tests.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from Catalog import config, database, migrations
+from Catalog.catalogDB import search_index
+from Catalog.fragmentCache import LRUBackend, fragment_cache
+
+def reset_engines():
+    """Drop the engines, the next get_engine() uses the current config"""
+    database.session.remove()
+    if database._replicas:
+        database._replicas.stop_checker()
+    database.dispose_engines()
+    database._engine = None
+    database._replicas = None
+
+class DatabaseTestCase(unittest.TestCase):
+    """Test case with a new database made by migrations.py for each test
+
+    Attributes:
+        folder: temporary folder of the database files
+    """
+    SETTINGS = ('DATABASE_URL', 'DATABASE_REPLICA_URLS')
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix = 'catalog-test-')
+        saved = dict((name, getattr(config, name)) for name in self.SETTINGS)
+        self.addCleanup(self.restore, saved)
+        config.DATABASE_URL = self.url('primary')
+        config.DATABASE_REPLICA_URLS = ''
+        reset_engines()
+        migrations.upgrade()
+        search_index.reset()
+        fragment_cache.use(LRUBackend())
+
+    def restore(self, saved):
+        reset_engines()
+        for name, value in saved.items():
+            setattr(config, name, value)
+        shutil.rmtree(self.folder)
+
+    def url(self, name):
+        return 'sqlite:///' + os.path.join(self.folder, name + '.sqlite')
+
+    def use_replicas(self, *names):
+        """Copy the primary to each replica and read from them
+
+        Returns:
+            list of the replica engines
+        """
+        database.session.remove()
+        for name in names:
+            shutil.copy(os.path.join(self.folder, 'primary.sqlite'),
+                        os.path.join(self.folder, name + '.sqlite'))
+        config.DATABASE_REPLICA_URLS = ','.join(self.url(name) for name in names)
+        return database.get_replicas().engines
@@ -0,0 +1,87 @@
+import os
+import threading
+import time
+import unittest
+
+from sqlalchemy import event
+
+from Catalog import app, config, database
+from Catalog.catalogDB import Category
+from Catalog.fragmentCache import fragment_cache
+from tests.support import DatabaseTestCase
+
+session = database.session
+
+class ReplicaTest(DatabaseTestCase):
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        Category.store(u'Cars')
+        session.remove()
+        self.replica, self.other = self.use_replicas('replica', 'other')
+        Category.store(u'Boats') # only on the primary
+        session.remove()
+        self.used = []
+        for engine in database.all_engines():
+            event.listen(engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, *a):
+        if threading.current_thread().name != 'replica-checker':
+            self.used.append(conn.engine)
+
+    def names(self):
+        return [c.name for c in Category.get_all()]
+
+    def test_reads_from_replica(self):
+        self.assertEqual(self.names(), [u'Cars'])
+        self.assertIn(self.used[-1], (self.replica, self.other))
+
+    def test_session_keeps_its_replica(self):
+        for _ in range(4):
+            self.names()
+        self.assertEqual(len(set(self.used)), 1)
+        session.remove()
+        self.names()
+        self.assertEqual(len(set(self.used)), 2) # the next session picks the other one
+
+    def test_writes_stick_to_primary(self):
+        Category.store(u'Planes')
+        self.assertEqual(self.names(), [u'Cars', u'Boats', u'Planes'])
+        self.assertEqual(set(self.used), set([database.get_engine()]))
+        self.assertTrue(session.info['wrote'])
+
+    def test_sticky_cookie(self):
+        until = '%d' % (time.time() + 60)
+        with app.test_request_context(headers = {'Cookie': '%s=%s' % (database.STICKY_COOKIE, until)}):
+            database.stick_to_primary()
+            self.assertEqual(self.names(), [u'Cars', u'Boats'])
+
+    def test_recent_invalidation_reads_primary(self):
+        fragment_cache.invalidate('categories')
+        fragment_cache.get_or_make('version:categories', ('categories',), Category.get_version)
+        self.assertEqual(self.names(), [u'Cars', u'Boats'])
+
+    def test_failover(self):
+        self.names()
+        picked = session.info['replica']
+        os.remove(picked.url.database)
+        os.mkdir(picked.url.database) # can't be opened any more
+        picked.dispose()
+        replicas = database.get_replicas()
+        replicas.check_all()
+        self.assertFalse(replicas.healthy[picked])
+        self.names()
+        self.assertNotEqual(self.used[-1], picked)
+
+        for engine in replicas.engines:
+            replicas.healthy[engine] = False
+        session.remove()
+        self.assertEqual(self.names(), [u'Cars', u'Boats'])
+        self.assertEqual(self.used[-1], database.get_engine())
+
+    def test_checks_in_background(self):
+        replicas = database.get_replicas()
+        self.names()
+        self.assertEqual(replicas.checker_pid, os.getpid())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from Catalog.fragmentCache import FileBackend, FragmentCache, LRUBackend
+
+class FragmentCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix = 'catalog-test-')
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.made = []
+
+    def make(self, value):
+        def make():
+            self.made.append(value)
+            return value
+        return make
+
+    def test_invalidate(self):
+        cache = FragmentCache(LRUBackend())
+        self.assertEqual(cache.get_or_make('list', ('items',), self.make(1)), 1)
+        self.assertEqual(cache.get_or_make('list', ('items',), self.make(2)), 1)
+        cache.invalidate('items')
+        self.assertEqual(cache.get_or_make('list', ('items',), self.make(3)), 3)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_shared_tags(self):
+        # two worker processes, each with its own entries
+        tags = FileBackend(os.path.join(self.folder, 'tags'))
+        one = FragmentCache(LRUBackend(), tag_backend = tags)
+        other = FragmentCache(LRUBackend(), tag_backend = FileBackend(tags.folder))
+        one.get_or_make('list', ('items',), self.make(1))
+        other.get_or_make('list', ('items',), self.make(1))
+        one.invalidate('items')
+        self.assertEqual(other.get_or_make('list', ('items',), self.make(2)), 2)
+        self.assertEqual(os.listdir(tags.folder), [tags.path('tag:items').split(os.sep)[-1]])
+
+    def test_counters_are_thread_safe(self):
+        cache = FragmentCache(LRUBackend())
+        def lookups():
+            for i in range(2000):
+                cache.get_or_make('entry %d' % (i % 10), (), self.make(i))
+        threads = [threading.Thread(target = lookups) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(cache.hits + cache.misses, 8000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from Catalog.imageIngest import ImageIngestor
+from Catalog.imageStore import ImageStore
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\0' * 100
+
+class Handler(BaseHTTPRequestHandler):
+    """Stand-in for the image hosts"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/image.png':
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(PNG)))
+            self.end_headers()
+            self.wfile.write(PNG)
+        elif self.path == '/moved':
+            self.send_response(302)
+            self.send_header('Location', '/image.png')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def log_message(self, *a):
+        pass
+
+class BrokenStore(ImageStore):
+    def put(self, tmp_path, digest, ext):
+        raise RuntimeError('broken store')
+
+class ImageIngestTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix = 'catalog-test-')
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target = self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.done = {}
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server.server_port, path)
+
+    def ingest(self, path, store = None):
+        store = store or ImageStore(self.folder + '/')
+        ingestor = ImageIngestor(store, self.on_done, workers = 1, retries = 1, backoff = 0)
+        self.addCleanup(ingestor.pool.close) # its keep-alive connection holds the server
+        ingestor.submit(1, self.url(path))
+        ingestor.wait()
+        return self.done[1]
+
+    def on_done(self, image_id, stored, error):
+        self.done[image_id] = (stored, error)
+
+    def test_download(self):
+        stored, error = self.ingest('/moved')
+        self.assertIsNone(error)
+        self.assertTrue(stored.src.endswith('.png'))
+        with open(stored.src[1:], 'rb') as f:
+            self.assertEqual(f.read(), PNG)
+
+    def test_not_found(self):
+        self.assertEqual(self.ingest('/missing'), (None, 'HTTP 404'))
+
+    def test_unexpected_error(self):
+        stored, error = self.ingest('/image.png', BrokenStore(self.folder + '/'))
+        self.assertIsNone(stored)
+        self.assertEqual(error, 'RuntimeError: broken store')
+        self.assertEqual([f for f in os.listdir(self.folder) if f.endswith('.part')], [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from Catalog import imageStore
+from Catalog.imageStore import ImageStore
+
+class ImageStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix = 'catalog-test-')
+        self.addCleanup(shutil.rmtree, self.folder)
+        cwd = os.getcwd()
+        os.chdir(self.folder) # the store folder is relative
+        self.addCleanup(os.chdir, cwd)
+        self.store = ImageStore('images/')
+
+    def download(self, color):
+        path = os.path.join(self.folder, 'download')
+        imageStore.PILImage.new('RGB', (1000, 500), color).save(path, 'PNG')
+        with open(path, 'rb') as f:
+            digest = imageStore.new_hash()
+            digest.update(f.read())
+        return path, digest.hexdigest()
+
+    @unittest.skipIf(imageStore.PILImage is None, 'PIL is not installed')
+    def test_put_and_derive(self):
+        path, digest = self.download('red')
+        stored = self.store.put(path, digest, '.png')
+        self.assertEqual(stored.src, '/images/%s/%s.png' % (digest[:2], digest))
+        for src in (stored.thumb_src, stored.medium_src):
+            mode = os.stat(src.lstrip('/')).st_mode
+            self.assertEqual(stat.S_IMODE(mode), 0o644)
+        files = os.listdir(os.path.join('images', digest[:2]))
+        self.assertEqual(len(files), 3)
+        self.assertFalse([f for f in files if f.endswith('.part')])
+
+    @unittest.skipIf(imageStore.PILImage is None, 'PIL is not installed')
+    def test_same_content_is_stored_once(self):
+        path, digest = self.download('blue')
+        first = self.store.put(path, digest, '.png')
+        path, digest = self.download('blue')
+        self.assertEqual(self.store.put(path, digest, '.png').src, first.src)
+        self.assertFalse(os.path.exists(path))
+
+if __name__ == '__main__':
+    unittest.main()
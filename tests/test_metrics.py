@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from Catalog import config, metrics
+from Catalog.metrics import ValueFile, aggregate, read_values, registry, value_path
+from tests.support import DatabaseTestCase
+
+REQUESTS = ('catalog_requests_total', (('endpoint', 'home'),))
+IN_PROGRESS = ('catalog_requests_in_progress', (('endpoint', 'home'),))
+
+class ValueFileTest(unittest.TestCase):
+    def test_read_back(self):
+        folder = tempfile.mkdtemp(prefix = 'catalog-test-')
+        self.addCleanup(shutil.rmtree, folder)
+        values = ValueFile(os.path.join(folder, 'values.db'), size = 64)
+        for i in range(50): # grows the file
+            values.add(('counters', 'c%d' % i, (('status', 200),), None), i)
+        values.add(('counters', 'c3', (('status', 200),), None), 0.5)
+        read = dict(read_values(values.path))
+        self.assertEqual(len(read), 50)
+        self.assertEqual(read[('counters', 'c3', (('status', 200),), None)], 3.5)
+        self.assertEqual(read[('counters', 'c49', (('status', 200),), None)], 49)
+
+class MultiProcessTest(DatabaseTestCase):
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        saved = config.METRICS_DIR
+        config.METRICS_DIR = os.path.join(self.folder, 'metrics')
+        os.mkdir(config.METRICS_DIR)
+        registry.file_pid = None
+        def restore():
+            config.METRICS_DIR = saved
+            registry.file_pid = None
+        self.addCleanup(restore)
+
+    def other_process(self, pid, start):
+        values = ValueFile(value_path(pid, start))
+        values.add(('counters',) + REQUESTS + (None,), 5)
+        values.add(('gauges',) + IN_PROGRESS + (None,), 1)
+        return values
+
+    def test_updates_are_written_through(self):
+        registry.inc(*REQUESTS)
+        path = value_path(os.getpid(), metrics.process_start(os.getpid()))
+        self.assertEqual(dict(read_values(path))[('counters',) + REQUESTS + (None,)], 1)
+
+    def test_exited_and_reused_pids(self):
+        registry.inc(*REQUESTS)
+        registry.add_gauge(*IN_PROGRESS)
+        self.other_process(os.getpid(), 'exited') # same pid, older process
+        self.other_process(2 ** 22 + 1, '1') # not running
+        total = aggregate()
+        self.assertEqual(total['counters'][REQUESTS], 11)
+        self.assertEqual(total['gauges'][IN_PROGRESS], 1)
+
+    def test_sampled_values(self):
+        total = aggregate()
+        self.assertIn(('catalog_db_pool_size', ()), total['gauges'])
+        self.assertIn(('catalog_fragment_cache_hits_total', ()), total['counters'])
+
+if __name__ == '__main__':
+    unittest.main()
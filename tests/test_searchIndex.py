@@ -0,0 +1,63 @@
+import unittest
+from collections import namedtuple
+
+from Catalog.searchIndex import PrefixIndex, SearchIndex
+
+Category = namedtuple('Category', 'id name')
+Item = namedtuple('Item', 'id title desc category_id')
+
+def index_of(categories, items):
+    return SearchIndex(lambda: (categories, items))
+
+class PrefixIndexTest(unittest.TestCase):
+    def test_category_after_many_items(self):
+        index = PrefixIndex()
+        for i in range(500):
+            index.add('item', i, u'Soccer ball %d' % i)
+        index.add('category', 1, u'Soccerz')
+        found = index.lookup(u'socc', k = 3)
+        self.assertEqual(found[0], ('category', 1, u'Soccerz'))
+
+    def test_bulk_equals_insort(self):
+        names = [u'Snowboard', u'Goggles', u'Snow shoes', u'Shin guards']
+        one_by_one, bulk = PrefixIndex(), PrefixIndex()
+        for i, name in enumerate(names):
+            one_by_one.add('item', i, name)
+            bulk.add('item', i, name, sort = False)
+        bulk.sort()
+        self.assertEqual(one_by_one.entries, bulk.entries)
+        self.assertEqual(bulk.lookup(u'sn'), one_by_one.lookup(u'sn'))
+
+    def test_remove(self):
+        index = PrefixIndex()
+        index.add('item', 1, u'Snowboard')
+        index.remove('item', 1)
+        self.assertEqual(index.lookup(u'snow'), [])
+
+class SearchIndexTest(unittest.TestCase):
+    def test_build(self):
+        index = index_of([Category(1, u'Snowboarding')],
+                         [Item(1, u'Goggles', u'Keep the snow out', 1),
+                          Item(2, u'Snowboard', u'Best for any terrain', 1)])
+        self.assertEqual(index.search(u'snowboard').item_ids[0], 2)
+        self.assertEqual(index.vocabulary, sorted(index.vocabulary))
+        self.assertEqual([s[:2] for s in index.suggest(u'snow')][0], ('category', 1))
+
+    def test_writes_during_build(self):
+        def loader():
+            # committed while the index is being built, after the rows were read
+            index.add_item(Item(3, u'Snow shovel', u'', 1))
+            index.remove_item(1)
+            return [Category(1, u'Snowboarding')], [Item(1, u'Goggles', u'', 1)]
+        index = SearchIndex(loader)
+        self.assertEqual(index.search(u'snow shovel').item_ids, [3])
+        self.assertEqual(index.search(u'goggles').item_ids, [])
+
+    def test_write_before_build_is_dropped(self):
+        index = index_of([], [])
+        index.add_item(Item(1, u'Goggles', u'', 1))
+        self.assertFalse(index.loaded)
+        self.assertEqual(index.search(u'goggles').item_ids, []) # not in the database
+
+if __name__ == '__main__':
+    unittest.main()